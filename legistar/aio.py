@@ -0,0 +1,117 @@
+"""
+asyncio front end for the Legistar API scrapers.
+
+The API scrapers make blocking requests through scrapelib, one after
+another. AsyncLegistarAPI wraps a scraper so its methods can be awaited.
+Each call runs in a thread from a bounded pool, and all threads share
+the scraper's session, connection pool and rate limit:
+
+    api = AsyncLegistarAPI(ChicagoBillScraper(jurisdiction, datadir),
+                           max_concurrency=10)
+
+    async def matter_with_history(matter) :
+        history, sponsors = await asyncio.gather(
+            api.history(matter['MatterId']),
+            api.sponsors(matter['MatterId']))
+        return matter, history, sponsors
+
+    async for matter, history, sponsors in amap(matter_with_history,
+                                                api.matters()) :
+        ...
+
+Generator methods like matters, events, bodies, agenda and rollcalls
+become async generators. Every other method, such as history, sponsors,
+attachments, topics, relations, text and votes, becomes a coroutine
+function.
+"""
+import asyncio
+import functools
+import inspect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .base import transport
+
+
+_END = object()
+
+
+class AsyncLegistarAPI(object) :
+    def __init__(self, scraper, max_concurrency=8) :
+        self.scraper = scraper
+        self.max_concurrency = max_concurrency
+
+        self._semaphore = None
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+        # Keep at least one connection per worker open, so concurrent
+        # requests reuse connections instead of opening and discarding
+        # extra ones
+        adapter = transport(scraper.POOL_CONNECTIONS,
+                            max(scraper.POOL_MAXSIZE, max_concurrency))
+        scraper.mount('http://', adapter)
+        scraper.mount('https://', adapter)
+
+    def __getattr__(self, name) :
+        method = getattr(self.scraper, name)
+
+        if inspect.isgeneratorfunction(method) :
+            @functools.wraps(method)
+            def async_generator(*args, **kwargs) :
+                return self.iterate(method, *args, **kwargs)
+            return async_generator
+
+        elif callable(method) :
+            @functools.wraps(method)
+            async def coroutine(*args, **kwargs) :
+                return await self.call(method, *args, **kwargs)
+            return coroutine
+
+        else :
+            return method
+
+    @property
+    def semaphore(self) :
+        # Created lazily, so it belongs to the running event loop
+        if self._semaphore is None :
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def call(self, func, *args, **kwargs) :
+        """Run the blocking func(*args, **kwargs) in the worker pool."""
+        async with self.semaphore :
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor,
+                                              functools.partial(func, *args, **kwargs))
+
+    async def iterate(self, generator_func, *args, **kwargs) :
+        """Iterate the blocking generator_func(*args, **kwargs) in the worker pool."""
+        iterator = generator_func(*args, **kwargs)
+        while True :
+            item = await self.call(next, iterator, _END)
+            if item is _END :
+                return
+            yield item
+
+    def close(self) :
+        self._executor.shutdown(wait=True)
+
+
+async def amap(coroutine_func, aiterable, window=16) :
+    """
+    Async counterpart of base.orderedMap. Starts coroutine_func(item)
+    for up to window items of aiterable at once, and yields the results
+    in the order of aiterable.
+    """
+    pending = deque()
+    try :
+        async for item in aiterable :
+            pending.append(asyncio.ensure_future(coroutine_func(item)))
+            if len(pending) >= window :
+                yield await pending.popleft()
+
+        while pending :
+            yield await pending.popleft()
+    finally :
+        for task in pending :
+            task.cancel()
@@ -1,27 +1,588 @@
+import contextlib
 import datetime
+import email.utils
+import functools
+import hashlib
 import itertools
+import threading
+import time
 import traceback
-from collections import defaultdict, deque
+from collections import Counter, OrderedDict, deque
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+import os
 import re
+from urllib.parse import urlencode, urlparse
 
+import requests
 import scrapelib
+from pupa import settings
 from pupa.scrape import Scraper
 import lxml.html
 import lxml.etree as etree
 import pytz
 
-class LegistarScraper(Scraper):
+from .storage import ResponseArchive, SqliteStore
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+_archives = {}
+_archives_lock = threading.Lock()
+
+
+def archive(path, max_bytes=None) :
+    """The process wide ResponseArchive at path"""
+    path = os.path.abspath(path)
+    with _archives_lock :
+        if path not in _archives :
+            _archives[path] = ResponseArchive(path, max_bytes)
+        return _archives[path]
+
+
+def transport(pool_connections, pool_maxsize) :
+    """
+    Return the process wide HTTP adapter with the given pool sizes, so
+    that every scraper configured the same way shares one set of
+    keep-alive connections.
+    """
+    key = (pool_connections, pool_maxsize)
+    with _transports_lock :
+        if key not in _transports :
+            _transports[key] = requests.adapters.HTTPAdapter(pool_connections=pool_connections,
+                                                             pool_maxsize=pool_maxsize)
+        return _transports[key]
+
+
+class AdaptiveRateLimiter(object) :
+    """
+    Spaces out requests to one host, adapting the rate to how the host
+    copes. Each success adds increase requests per second, up to
+    max_rate, and each failure multiplies the rate by decrease, down to
+    min_rate. A Retry-After from the server holds every request to the
+    host until it has passed.
+    """
+    def __init__(self, rate, min_rate, max_rate, increase, decrease) :
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+
+        self._next_request = 0
+        self._lock = threading.Lock()
+
+    def wait(self) :
+        """Block until the next request to the host is allowed"""
+        with self._lock :
+            now = time.time()
+            start = max(now, self._next_request)
+            self._next_request = start + 1 / self.rate
+
+        if start > now :
+            time.sleep(start - now)
+
+    def success(self) :
+        with self._lock :
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def failure(self, retry_after=None) :
+        with self._lock :
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            if retry_after :
+                self._next_request = max(self._next_request,
+                                         time.time() + retry_after)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def rateLimiter(host, **settings) :
+    """
+    The process wide AdaptiveRateLimiter for host, created with
+    settings by the first scraper to use it.
+    """
+    with _limiters_lock :
+        if host not in _limiters :
+            _limiters[host] = AdaptiveRateLimiter(**settings)
+        return _limiters[host]
+
+
+def adaptiveRates() :
+    """The current requests per second allowed to each host"""
+    with _limiters_lock :
+        return {host : limiter.rate for host, limiter in _limiters.items()}
+
+
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+_held_slots = threading.local()
+
+
+def limitHost(host, max_concurrent) :
+    """
+    Allow at most max_concurrent requests to host at once, across every
+    scraper in the process. None removes the limit.
+    """
+    with _host_slots_lock :
+        if max_concurrent is None :
+            _host_slots.pop(host, None)
+        else :
+            _host_slots[host] = threading.BoundedSemaphore(max_concurrent)
+
+
+@contextlib.contextmanager
+def hostSlot(host) :
+    """
+    Hold one of host's request slots, if it is limited. A thread that
+    already holds one, while following a redirect, does not take
+    another.
+    """
+    slots = _host_slots.get(host)
+    held = getattr(_held_slots, 'hosts', None)
+    if held is None :
+        held = _held_slots.hosts = set()
+
+    if slots is None or host in held :
+        yield
+        return
+
+    with slots :
+        held.add(host)
+        try :
+            yield
+        finally :
+            held.discard(host)
+
+
+def retryAfter(response) :
+    """Seconds to wait from a response's Retry-After header, or None"""
+    value = response.headers.get('Retry-After')
+    if value is None :
+        return None
+    try :
+        return max(0, float(value))
+    except ValueError :
+        pass
+    try :
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError) :
+        return None
+    return max(0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def connectionStats() :
+    """
+    Connection reuse per host across the shared transports. Hosts whose
+    pools have been dropped, because more than pool_connections hosts
+    were in use, are not reported.
+    """
+    hosts = {}
+    with _transports_lock :
+        adapters = list(_transports.values())
+
+    for adapter in adapters :
+        pools = adapter.poolmanager.pools
+        for key in pools.keys() :
+            pool = pools.get(key)
+            if pool is None :
+                continue
+            host = hosts.setdefault(pool.host, {'connections': 0, 'requests': 0})
+            host['connections'] += pool.num_connections
+            host['requests'] += pool.num_requests
+
+    for host in hosts.values() :
+        host['reuse rate'] = (1 - host['connections'] / host['requests']
+                              if host['requests'] else 0.0)
+
+    return hosts
+
+
+class LegistarSession(Scraper):
+    """
+    Plumbing shared by the web and API scrapers: run statistics, a
+    throttle that worker threads can share, and persistent state.
+    """
+    # Directory for state kept between runs. Defaults to a legistar
+    # directory in pupa's cache directory
+    STATE_DIR = None
+
+    # Connection pooling, shared by every scraper in the process with
+    # the same settings. POOL_CONNECTIONS is the number of hosts to keep
+    # pools for, POOL_MAXSIZE the connections kept open to each host
+    POOL_CONNECTIONS = 10
+    POOL_MAXSIZE = 10
+    KEEP_ALIVE = True
+
+    # Pick up matters, events and legislation from the watermark of the
+    # last complete run when they are called without a since or
+    # created_after argument
+    INCREMENTAL = True
+
+    # API watermarks are the time a run started, less this overlap, so
+    # that edits made while it ran, or stamped by a server clock behind
+    # ours, are fetched again next time
+    WATERMARK_OVERLAP = datetime.timedelta(hours=1)
+
+    # Items a run fetched but could not use, like matters without a web
+    # page, hold the watermark back so they are retried. Items older
+    # than this are given up on
+    WATERMARK_MAX_RETRY = datetime.timedelta(days=7)
+
+    # Revalidate GET responses with If-None-Match and If-Modified-Since
+    # instead of downloading them again. Responses with an ETag or
+    # Last-Modified header, up to CONDITIONAL_MAX_BYTES, are kept, in a
+    # store evicting the least recently used past CONDITIONAL_STORE_MAX_BYTES
+    CONDITIONAL_GET = False
+    CONDITIONAL_MAX_BYTES = 8 * 1024 * 1024
+    CONDITIONAL_STORE_MAX_BYTES = 256 * 1024 * 1024
+
+    # Replace pupa's scrapelib.FileCache, one uncompressed file per URL,
+    # with a compressed ResponseArchive in the legistar cache directory,
+    # holding at most ARCHIVE_MAX_BYTES of compressed bodies
+    ARCHIVE_CACHE = False
+    ARCHIVE_MAX_BYTES = 1024 ** 3
+
+    # Also cache POST requests, keyed by URL and form data, so that
+    # searches and grid paging can be replayed in fastmode
+    CACHE_POSTS = False
+
+    # Replace the fixed requests_per_minute with a rate per host, shared
+    # by every scraper in the process, that backs off multiplicatively
+    # on server errors, Error.aspx and timeouts, and creeps back up on
+    # success. Rates are in requests per second
+    ADAPTIVE_RATE = False
+    ADAPTIVE_INITIAL_RATE = 1.0
+    ADAPTIVE_MIN_RATE = 0.1
+    ADAPTIVE_MAX_RATE = 10.0
+    ADAPTIVE_INCREASE = 0.05
+    ADAPTIVE_DECREASE = 0.5
+
+    def __init__(self, *args, **kwargs) :
+        super(LegistarSession, self).__init__(*args, **kwargs)
+        self._throttle_lock = threading.Lock()
+
+        adapter = transport(self.POOL_CONNECTIONS, self.POOL_MAXSIZE)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        if not self.KEEP_ALIVE :
+            self.headers['Connection'] = 'close'
+
+        if self.ARCHIVE_CACHE and isinstance(self.cache_storage, scrapelib.FileCache) :
+            self.cache_storage = archive(os.path.join(self.stateDir(), 'archive.sqlite3'),
+                                         self.ARCHIVE_MAX_BYTES)
+
+        self._responses = None
+        self._uncached = threading.local()
+
+        if self.ADAPTIVE_RATE :
+            self.requests_per_minute = 0
+
+        # Run statistics, e.g. the number of pages fetched by kind
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+
+    def count(self, stat, n=1) :
+        with self._stats_lock :
+            self.stats[stat] += n
+
+    def state(self, name) :
+        """
+        Return the persistent mapping called name from this
+        jurisdiction's state file.
+        """
+        return SqliteStore(self.statePath('.sqlite3'), name)
+
+    def stateDir(self) :
+        return self.STATE_DIR or os.path.join(settings.CACHE_DIR, 'legistar')
+
+    def statePath(self, extension) :
+        """The path of this jurisdiction's state file with extension"""
+        jurisdiction_id = getattr(self.jurisdiction, 'jurisdiction_id', None) or 'default'
+        filename = re.sub(r'[^\w.-]+', '_', jurisdiction_id) + extension
+
+        return os.path.join(self.stateDir(), filename)
+
+    def endpoint_name(self, url) :
+        """The route of url, with ids replaced by {id}, for stats"""
+        base_url = getattr(self, 'BASE_URL', None)
+        if base_url and url.startswith(base_url) :
+            route = url[len(base_url):].split('?')[0]
+        else :
+            route = urlparse(url).path
+        return re.sub(r'/\d+(?=/|$)', '/{id}', route).rstrip('/')
+
+    def request(self, method, url, params=None, headers=None, **kwargs) :
+        """
+        With CONDITIONAL_GET, GET requests for responses we have kept
+        send their validators, and a 304 Not Modified is answered with
+        the kept response. Stats count conditional misses (nothing
+        kept), revalidations and hits (304s) per endpoint.
+        """
+        if not self.CONDITIONAL_GET or method.upper() != 'GET' :
+            return super(LegistarSession, self).request(method, url, params=params,
+                                                        headers=headers, **kwargs)
+
+        key = requests.Request('GET', url, params=params).prepare().url
+        endpoint = self.endpoint_name(url)
+
+        responses = self.responseStore()
+        kept = responses.get(key)
+
+        headers = dict(headers or {})
+        if kept is None :
+            self.count('conditional misses ' + endpoint)
+        else :
+            self.count('conditional revalidations ' + endpoint)
+            if 'ETag' in kept.headers :
+                headers['If-None-Match'] = kept.headers['ETag']
+            if 'Last-Modified' in kept.headers :
+                headers['If-Modified-Since'] = kept.headers['Last-Modified']
+
+        response = super(LegistarSession, self).request(method, url, params=params,
+                                                        headers=headers, **kwargs)
+
+        if response.status_code == 304 and kept is not None :
+            self.count('conditional hits ' + endpoint)
+            kept.request = response.request
+            return kept
+
+        if (response.status_code == 200
+            and not getattr(response, 'fromcache', False)
+            and ('ETag' in response.headers or 'Last-Modified' in response.headers)) :
+
+            # A streamed body is only read here if it is small enough
+            length = response.headers.get('Content-Length')
+            if not kwargs.get('stream') or (length and int(length) <= self.CONDITIONAL_MAX_BYTES) :
+                if len(response.content) <= self.CONDITIONAL_MAX_BYTES :
+                    responses.set(key, response)
+
+        return response
+
+    def send(self, request, **kwargs) :
+        """
+        Every attempt, including retries and redirects, passes through
+        here. If the host has a concurrency limit (see limitHost) we
+        wait for a free slot. With ADAPTIVE_RATE we also wait for the
+        host's limiter, and tell it how the request went.
+        """
+        host = urlparse(request.url).netloc
+        with hostSlot(host) :
+            if not self.ADAPTIVE_RATE :
+                return super(LegistarSession, self).send(request, **kwargs)
+
+            return self._adaptiveSend(host, request, **kwargs)
+
+    def _adaptiveSend(self, host, request, **kwargs) :
+        limiter = rateLimiter(host,
+                              rate=self.ADAPTIVE_INITIAL_RATE,
+                              min_rate=self.ADAPTIVE_MIN_RATE,
+                              max_rate=self.ADAPTIVE_MAX_RATE,
+                              increase=self.ADAPTIVE_INCREASE,
+                              decrease=self.ADAPTIVE_DECREASE)
+        limiter.wait()
+
+        try :
+            response = super(LegistarSession, self).send(request, **kwargs)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) :
+            limiter.failure()
+            self._recordRate(host, limiter, 'timeouts')
+            raise
+
+        # After redirects, each later hop has been through here itself
+        if response.history :
+            return response
+
+        if response.status_code >= 500 or response.status_code == 429 :
+            limiter.failure(retryAfter(response))
+            self._recordRate(host, limiter, 'server errors')
+        elif 'Error.aspx' in response.url :
+            limiter.failure()
+            self._recordRate(host, limiter, 'error pages')
+        else :
+            limiter.success()
+            self._recordRate(host, limiter)
+
+        return response
+
+    def _recordRate(self, host, limiter, failure=None) :
+        with self._stats_lock :
+            if failure :
+                self.stats['backoffs on {} {}'.format(failure, host)] += 1
+            self.stats['requests per second ' + host] = limiter.rate
+
+    def responseStore(self) :
+        """The responses kept for this jurisdiction by CONDITIONAL_GET"""
+        if self._responses is None :
+            self._responses = archive(self.statePath('.responses.sqlite3'),
+                                      self.CONDITIONAL_STORE_MAX_BYTES)
+        return self._responses
+
+    @contextlib.contextmanager
+    def uncached(self) :
+        """
+        Skip scrapelib's cache for requests made by this thread in the
+        block, keeping the throttle and retries. Streamed responses
+        need this, since caching reads the whole body into memory.
+        """
+        self._uncached.active = True
+        try :
+            yield
+        finally :
+            self._uncached.active = False
+
+    def key_for_request(self, method, url, params=None, data=None, **kwargs) :
+        """
+        Cache keys for scrapelib. GET requests are keyed by URL as
+        usual. With CACHE_POSTS, POST requests, which page through
+        search results and grids, are keyed by URL and a hash of the
+        form data. Nothing is cached inside uncached().
+        """
+        if getattr(self._uncached, 'active', False) :
+            return None
+
+        if method.lower() != 'post' or not self.CACHE_POSTS :
+            return super(LegistarSession, self).key_for_request(method, url, params=params,
+                                                                data=data, **kwargs)
+
+        url = requests.Request(url=url, params=params).prepare().url
+        if isinstance(data, dict) :
+            data = urlencode(sorted(data.items()), doseq=True)
+        if isinstance(data, str) :
+            data = data.encode('utf-8')
+
+        return 'POST {} {}'.format(url, hashlib.sha256(data or b'').hexdigest())
+
+    def watermark(self, name) :
+        """
+        The watermark called name saved by the last complete run, or
+        None if there is none or INCREMENTAL is off.
+        """
+        if not self.INCREMENTAL :
+            return None
+        return self.state('watermarks').get(name)
+
+    def setWatermark(self, name, value) :
+        """
+        Save value as the watermark called name, unless the saved one is
+        later. Call this only once everything up to value has been
+        yielded, so an interrupted run is repeated from the old mark.
+        """
+        if value is None :
+            return
+
+        watermarks = self.state('watermarks')
+        previous = watermarks.get(name)
+        if previous is None or value > previous :
+            watermarks[name] = value
+
+    def runWatermark(self, started, retry=()) :
+        """
+        The watermark for an API run that started at started, a naive
+        UTC datetime. retry holds the last modified times of items the
+        run skipped, which the next run should fetch again.
+        """
+        watermark = started - self.WATERMARK_OVERLAP
+        oldest = started - self.WATERMARK_MAX_RETRY
+
+        for modified in retry :
+            # The filter is 'gt', so step back below the skipped item
+            modified = parseTime(modified[:19], '%Y-%m-%dT%H:%M:%S') - datetime.timedelta(seconds=1)
+            if modified < oldest :
+                self.count('watermark retries given up')
+            else :
+                watermark = min(watermark, modified)
+
+        return watermark.strftime('%Y-%m-%dT%H:%M:%S')
+
+    def rawRequest(self, method, url, **kwargs) :
+        """
+        Send one request over the shared connection pool, respecting the
+        throttle but skipping scrapelib's cache and retries. Errors are
+        returned as responses, not raised.
+        """
+        if self._throttled :
+            self._throttle()
+        kwargs.setdefault('timeout', self.timeout)
+        self.count('uncached {}'.format(method.upper()))
+        return requests.Session.request(self, method, url, **kwargs)
+
+    def _throttle(self) :
+        # scrapelib's throttle is not thread safe. Serialize it so that
+        # worker threads sharing this scraper still respect
+        # requests_per_minute
+        with self._throttle_lock :
+            super(LegistarSession, self)._throttle()
+
+
+class LegistarScraper(LegistarSession):
     date_format='%m/%d/%Y'
 
+    # Bytes read at a time by streamDataTable
+    STREAM_CHUNK_SIZE = 64 * 1024
+
+    # XPath expressions for the parts of Legistar pages we scrape. They
+    # are compiled once and looked up by name with self.xpath(). A
+    # jurisdiction with unusual markup can override entries, e.g.
+    #
+    #     XPATHS = dict(LegistarScraper.XPATHS,
+    #                   people_table="//table[@id='...']")
+    XPATHS = {
+        # paging and ASP.NET state
+        'next_page' : "//a[@class='rgCurrentPage']/following-sibling::a[1]",
+        'viewstate' : "//input[@name='__VIEWSTATE']/@value",
+        'eventvalidation' : "//input[@name='__EVENTVALIDATION']/@value",
+
+        # data tables
+        'master_table' : "//table[@class='rgMasterTable']",
+        'table_headers' : ".//th[starts-with(@class, 'rgHeader')]",
+        'table_rows' : ".//tr[@class='rgRow' or @class='rgAltRow']",
+        'header_input' : ".//input",
+        'cells' : "./td",
+        'line_breaks' : "*//br",
+        'emphasis' : "*//em",
+
+        # detail sections
+        'detail_fields' : ".//*[starts-with(@id, 'ctl00_ContentPlaceHolder1_lbl')"
+                          " or starts-with(@id, 'ctl00_ContentPlaceHolder1_hyp')]",
+        'links' : ".//a",
+        'div_by_id' : ".//div[@id=$id]",
+
+        # page specific elements
+        'main_grid' : "//table[@id='ctl00_ContentPlaceHolder1_gridMain_ctl00']",
+        'search_switcher' : "//input[@id='ctl00_ContentPlaceHolder1_btnSwitch']",
+        'page_details' : ".//div[@id='ctl00_ContentPlaceHolder1_pageDetails']",
+        'action_details' : ".//div[@id='ctl00_ContentPlaceHolder1_pageTop1']",
+        'history_table' : "//table[@id='ctl00_ContentPlaceHolder1_gridLegislation_ctl00']",
+        'vote_table' : "//table[@id='ctl00_ContentPlaceHolder1_gridVote_ctl00']",
+        'legislation_text' : "//div[@id='ctl00_ContentPlaceHolder1_divText']",
+        'years_input' : "//input[@id='ctl00_ContentPlaceHolder1_lstYears_Input']",
+        'rollcall_table' : "//table[@id='ctl00_ContentPlaceHolder1_gridRollCall_ctl00']",
+        'people_table' : "//table[@id='ctl00_ContentPlaceHolder1_gridPeople_ctl00']",
+        'photo' : "//img[@id='ctl00_ContentPlaceHolder1_imgPhoto']",
+        'committee_table' : "//table[@id='ctl00_ContentPlaceHolder1_gridDepartments_ctl00']",
+    }
+
     def __init__(self, *args, **kwargs) :
         super(LegistarScraper, self).__init__(*args, **kwargs)
         self.timeout = 600
 
+    def xpath(self, element, name, **variables) :
+        """
+        Evaluate the registered XPath expression called name against
+        element. Keyword arguments are bound to XPath variables.
+        """
+        return compiledXPath(self.XPATHS[name])(element, **variables)
+
     def lxmlize(self, url, payload=None):
         if payload :
             response = self.post(url, payload, verify=False)
+            method = 'POST'
         else :
             response = self.get(url, verify=False)
+            method = 'GET'
+        self.count('{} {}'.format(method, urlparse(url).path.split('/')[-1]))
         self._check_errors(response)
         entry = response.text
         page = lxml.html.fromstring(entry)
@@ -33,34 +594,130 @@ class LegistarScraper(Scraper):
         
         yield page
 
-        next_page = page.xpath("//a[@class='rgCurrentPage']/following-sibling::a[1]")
+        next_page = self.xpath(page, 'next_page')
         if payload and 'ctl00$ContentPlaceHolder1$btnSearch' in payload:
             del payload['ctl00$ContentPlaceHolder1$btnSearch']
 
         while len(next_page) > 0 :
-            if payload is None:
-                payload = {}
-            
-            payload.update(self.sessionSecrets(page))
-
-            event_target = next_page[0].attrib['href'].split("'")[1]
-
-            payload['__EVENTTARGET'] = event_target
+            payload = self._nextPagePayload(page, next_page, payload)
 
             page = self.lxmlize(url, payload)
 
             yield page
 
-            next_page = page.xpath("//a[@class='rgCurrentPage']/following-sibling::a[1]")
+            next_page = self.xpath(page, 'next_page')
+
+    def _nextPagePayload(self, page, next_page, payload) :
+        if payload is None:
+            payload = {}
+        
+        payload.update(self.sessionSecrets(page))
+
+        event_target = next_page[0].attrib['href'].split("'")[1]
+
+        payload['__EVENTTARGET'] = event_target
+
+        return payload
+
+    def streamDataTable(self, url, payload=None,
+                        table_id='ctl00_ContentPlaceHolder1_gridMain_ctl00',
+                        keep_rows=True) :
+        """
+        Like running parseDataTable over every page of pages(url,
+        payload), but each response is parsed incrementally and the
+        rows of the table with id table_id are yielded as soon as they
+        are read. A row element is cleared and dropped from the tree
+        once the consumer asks for the next one, so memory stays flat
+        however many rows the grid has. Don't keep the yielded rows, or
+        pass keep_rows=False to get None in their place.
+        """
+        page = yield from self._streamTablePage(url, payload, table_id,
+                                                keep_rows)
+
+        next_page = self.xpath(page, 'next_page')
+        if payload and 'ctl00$ContentPlaceHolder1$btnSearch' in payload:
+            del payload['ctl00$ContentPlaceHolder1$btnSearch']
+
+        while len(next_page) > 0 :
+            payload = self._nextPagePayload(page, next_page, payload)
+
+            page = yield from self._streamTablePage(url, payload, table_id,
+                                                    keep_rows)
 
+            next_page = self.xpath(page, 'next_page')
+
+    def _streamTablePage(self, url, payload, table_id, keep_rows) :
+        # Caching would read the whole page before we parse any of it
+        with self.uncached() :
+            if payload :
+                response = self.post(url, payload, verify=False, stream=True)
+                method = 'POST'
+            else :
+                response = self.get(url, verify=False, stream=True)
+                method = 'GET'
+        self.count('{} {}'.format(method, urlparse(url).path.split('/')[-1]))
+        self._check_errors(response)
+
+        parser = etree.HTMLPullParser(events=('start', 'end'),
+                                      encoding=response.encoding)
+        parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
+
+        table = None
+        headers = []
+        schema = None
+
+        for chunk in response.iter_content(chunk_size=self.STREAM_CHUNK_SIZE) :
+            parser.feed(chunk)
+
+            for event, element in parser.read_events() :
+                if event == 'start' :
+                    if (table is None
+                        and element.tag == 'table'
+                        and element.get('id') == table_id) :
+                        table = element
+                    continue
+
+                if table is None or element.tag not in ('th', 'tr') :
+                    continue
+                if next(element.iterancestors('table'), None) is not table :
+                    continue
+
+                if element.tag == 'th' :
+                    if element.get('class', '').startswith('rgHeader') :
+                        headers.append(element)
+
+                elif element.get('class') in ('rgRow', 'rgAltRow') :
+                    if schema is None :
+                        schema = TableSchema(self._tableKeys(headers))
+
+                    element.make_links_absolute(url)
+
+                    yield (self._parseRow(schema, element),
+                           schema.keys,
+                           element if keep_rows else None)
+
+                    # Free the row, and the emptied rows before it
+                    element.clear()
+                    parent = element.getparent()
+                    while element.getprevious() is not None :
+                        del parent[0]
+
+        page = parser.close()
+
+        # Like indexing the grid xpath on a parsed page, so a page
+        # without results isn't taken for an empty search
+        if table is None :
+            raise IndexError('no table with id {} in {}'.format(table_id, url))
+
+        page.make_links_absolute(url)
+
+        return page
 
     def parseDetails(self, detail_div) :
         """
         Parse the data in the top section of a detail page.
         """
-        detail_query = ".//*[starts-with(@id, 'ctl00_ContentPlaceHolder1_lbl')"\
-                       "     or starts-with(@id, 'ctl00_ContentPlaceHolder1_hyp')]"
-        fields = detail_div.xpath(detail_query)
+        fields = self.xpath(detail_div, 'detail_fields')
         details = {}
 
         for field_key, field in itertools.groupby(fields, 
@@ -70,7 +727,7 @@ class LegistarScraper(Scraper):
             key = field_1.text_content().replace(':', '').strip()
             if field_2.find('.//a') is not None :
                 value = []
-                for link in field_2.xpath('.//a') :
+                for link in self.xpath(field_2, 'links') :
                     value.append({'label' : link.text_content().strip(),
                                   'url' : self._get_link_address(link)})
             elif 'href' in field_2.attrib :
@@ -84,53 +741,69 @@ class LegistarScraper(Scraper):
         return details
 
 
-    def parseDataTable(self, table):
+    def parseDataTable(self, table, keep_rows=True):
         """
         Legistar uses the same kind of data table in a number of
         places. This will return a list of dictionaries using the
         table headers as keys.
+
+        Each row is a TableRow, which behaves like a dictionary whose
+        missing keys are None. Pass keep_rows=False to get None instead
+        of the lxml row element, so a list of results does not keep the
+        page alive.
         """
-        headers = table.xpath(".//th[starts-with(@class, 'rgHeader')]")
-        rows = table.xpath(".//tr[@class='rgRow' or @class='rgAltRow']")
+        headers = self.xpath(table, 'table_headers')
+        rows = self.xpath(table, 'table_rows')
+
+        schema = TableSchema(self._tableKeys(headers))
+
+        for row in rows:
+            yield (self._parseRow(schema, row),
+                   schema.keys,
+                   row if keep_rows else None)
 
+    def _tableKeys(self, headers) :
         keys = []
         for header in headers :
             text_content = header.text_content().replace('&nbsp;', ' ').strip()
             if text_content :
                 keys.append(text_content)
             else :
-                keys.append(header.xpath('.//input')[0].value)
+                keys.append(self.xpath(header, 'header_input')[0].value)
 
-        for row in rows:
-            try:
-                data = defaultdict(lambda : None)
-
-                for key, field in zip(keys, row.xpath("./td")):
-                    text_content = self._stringify(field)
-
-                    if field.find('.//a') is not None :
-                        address = self._get_link_address(field.find('.//a'))
-                        if address :
-                            if key == '' and 'View.ashx?M=IC' in address:
-                                key = 'iCalendar'
-                                value = {'url': address}
-                            else :
-                                value = {'label': text_content, 
-                                         'url': address}
+        return keys
+
+    def _parseRow(self, schema, row) :
+        try:
+            values = [_MISSING] * len(schema.keys)
+            extra = None
+
+            for key, field in zip(schema.keys, self.xpath(row, 'cells')):
+                text_content = self._stringify(field)
+
+                if field.find('.//a') is not None :
+                    address = self._get_link_address(field.find('.//a'))
+                    if address :
+                        if key == '' and 'View.ashx?M=IC' in address:
+                            extra = {'iCalendar' : {'url': address}}
+                            continue
                         else :
-                            value = text_content
+                            value = {'label': text_content, 
+                                     'url': address}
                     else :
                         value = text_content
+                else :
+                    value = text_content
 
-                    data[key] = value
+                values[schema.index[key]] = value
 
-                yield data, keys, row
+            return TableRow(schema, values, extra)
 
-            except Exception as e:
-                print('Problem parsing row:')
-                print(etree.tostring(row))
-                print(traceback.format_exc())
-                raise e
+        except Exception as e:
+            print('Problem parsing row:')
+            print(etree.tostring(row))
+            print(traceback.format_exc())
+            raise e
 
     def _get_link_address(self, link):
         url = None
@@ -147,17 +820,15 @@ class LegistarScraper(Scraper):
         return url
 
     def _stringify(self, field) :
-        for br in field.xpath("*//br"):
+        for br in self.xpath(field, 'line_breaks'):
             br.tail = "\n" + br.tail if br.tail else "\n"
-        for em in field.xpath("*//em"):
+        for em in self.xpath(field, 'emphasis'):
             if em.text :
                 em.text = "--em--" + em.text + "--em--"
         return field.text_content().replace('&nbsp;', ' ').strip()
 
     def toTime(self, text) :
-        time = datetime.datetime.strptime(text, self.date_format)
-        time = pytz.timezone(self.TIMEZONE).localize(time)
-        return time
+        return localTime(text, self.date_format, self.TIMEZONE)
 
     def toDate(self, text) :
         return self.toTime(text).date().isoformat()
@@ -173,9 +844,9 @@ class LegistarScraper(Scraper):
 
         payload = {}
         payload['__EVENTARGUMENT'] = None
-        payload['__VIEWSTATE'] = page.xpath("//input[@name='__VIEWSTATE']/@value")[0]
+        payload['__VIEWSTATE'] = self.xpath(page, 'viewstate')[0]
         try :
-            payload['__EVENTVALIDATION'] = page.xpath("//input[@name='__EVENTVALIDATION']/@value")[0]
+            payload['__EVENTVALIDATION'] = self.xpath(page, 'eventvalidation')[0]
         except IndexError :
             pass
 
@@ -187,6 +858,228 @@ class LegistarScraper(Scraper):
             raise scrapelib.HTTPError(response)
 
 
+@functools.lru_cache(maxsize=None)
+def timezone(name) :
+    return pytz.timezone(name)
+
+
+@functools.lru_cache(maxsize=4096)
+def localTime(text, date_format, timezone_name) :
+    """
+    Parse text with date_format and localize it to timezone_name.
+
+    Legistar repeats the same handful of dates throughout a scrape, so
+    results are memoized. They are aware datetimes, which are immutable
+    and safe to share.
+    """
+    time = parseTime(text, date_format)
+    return timezone(timezone_name).localize(time)
+
+
+def parseTime(text, date_format) :
+    """
+    datetime.datetime.strptime, with fast paths for the two formats
+    Legistar uses. Anything the fast paths do not recognize is left to
+    strptime, so errors are the same.
+    """
+    try :
+        if date_format == '%m/%d/%Y' :
+            month, day, year = text.split('/')
+            if (len(month) <= 2 and month.isdigit()
+                and len(day) <= 2 and day.isdigit()
+                and len(year) == 4 and year.isdigit()) :
+                return datetime.datetime(int(year), int(month), int(day))
+
+        elif date_format == '%Y-%m-%dT%H:%M:%S' :
+            if (len(text) == 19
+                and text[4] == text[7] == '-'
+                and text[10] == 'T'
+                and text[13] == text[16] == ':') :
+                fields = (text[0:4], text[5:7], text[8:10],
+                          text[11:13], text[14:16], text[17:19])
+                if all(field.isdigit() for field in fields) :
+                    return datetime.datetime(*(int(field) for field in fields))
+
+    except ValueError :
+        pass
+
+    return datetime.datetime.strptime(text, date_format)
+
+
+_MISSING = object()
+
+class TableSchema(object) :
+    """
+    The column keys of a data table, computed once and shared by all
+    of its rows.
+    """
+    __slots__ = ('keys', 'index')
+
+    def __init__(self, keys) :
+        self.keys = keys
+        self.index = {key : i for i, key in enumerate(keys)}
+
+
+class TableRow(MutableMapping) :
+    """
+    A row of a data table. Values for the table's columns are kept in a
+    list laid out by the shared TableSchema, and any other keys that
+    get set on the row go in a small dictionary. As with a
+    defaultdict(lambda : None), looking up a missing key gives None.
+
+    Rows used to be defaultdicts. A TableRow supports the same item
+    access and copy(), and compares equal to a dict with the same
+    items, but it is not a dict: isinstance(row, dict) is false and
+    json.dumps needs row.to_dict().
+    """
+    __slots__ = ('_schema', '_values', '_extra')
+
+    def __init__(self, schema, values, extra=None) :
+        self._schema = schema
+        self._values = values
+        self._extra = extra
+
+    def __getitem__(self, key) :
+        i = self._schema.index.get(key)
+        if i is not None and self._values[i] is not _MISSING :
+            return self._values[i]
+        elif self._extra :
+            return self._extra.get(key)
+        else :
+            return None
+
+    def __setitem__(self, key, value) :
+        i = self._schema.index.get(key)
+        if i is not None :
+            self._values[i] = value
+        else :
+            if self._extra is None :
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key) :
+        i = self._schema.index.get(key)
+        if i is not None and self._values[i] is not _MISSING :
+            self._values[i] = _MISSING
+        elif self._extra and key in self._extra :
+            del self._extra[key]
+        else :
+            raise KeyError(key)
+
+    def __contains__(self, key) :
+        i = self._schema.index.get(key)
+        if i is not None and self._values[i] is not _MISSING :
+            return True
+        return bool(self._extra) and key in self._extra
+
+    def __iter__(self) :
+        for key, i in self._schema.index.items() :
+            if self._values[i] is not _MISSING :
+                yield key
+        if self._extra :
+            yield from self._extra
+
+    def __len__(self) :
+        return sum(1 for _ in self)
+
+    def get(self, key, default=None) :
+        if key in self :
+            return self[key]
+        return default
+
+    def copy(self) :
+        """A shallow copy, like dict.copy"""
+        return TableRow(self._schema, list(self._values),
+                        dict(self._extra) if self._extra else None)
+
+    def to_dict(self) :
+        """The row's items as a plain dict"""
+        return dict(self)
+
+    def __repr__(self) :
+        return 'TableRow({!r})'.format(dict(self))
+
+
+_compiled_xpaths = threading.local()
+
+def compiledXPath(expression) :
+    """
+    Return expression compiled as an lxml XPath object. Compiled
+    expressions are cached per thread, as lxml XPath objects should not
+    be shared between threads.
+    """
+    try :
+        cache = _compiled_xpaths.cache
+    except AttributeError :
+        cache = _compiled_xpaths.cache = {}
+
+    try :
+        return cache[expression]
+    except KeyError :
+        compiled = cache[expression] = etree.XPath(expression)
+        return compiled
+
+
+class LRUCache(OrderedDict) :
+    """
+    A dictionary that holds at most maxsize items, evicting the least
+    recently used one when full.
+    """
+    def __init__(self, maxsize=128) :
+        super(LRUCache, self).__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key) :
+        value = super(LRUCache, self).__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value) :
+        super(LRUCache, self).__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize :
+            self.popitem(last=False)
+
+    def get(self, key, default=None) :
+        try :
+            return self[key]
+        except KeyError :
+            return default
+
+
+def orderedMap(func, iterable, max_workers) :
+    """
+    Like map, but calls func in a pool of max_workers threads. Results
+    are yielded in the order of iterable, and only a bounded window of
+    items is submitted ahead of the consumer.
+    """
+    window = 2 * max_workers
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor :
+        try :
+            for item in iterable :
+                pending.append(executor.submit(func, item))
+                if len(pending) >= window :
+                    yield pending.popleft().result()
+
+            while pending :
+                yield pending.popleft().result()
+        finally :
+            for future in pending :
+                future.cancel()
+
+
+def chunked(iterable, size) :
+    """Yield lists of up to size items from iterable"""
+    iterator = iter(iterable)
+    while True :
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk :
+            return
+        yield chunk
+
+
 def fieldKey(x) :
     field_id = x.attrib['id']
     field = re.split(r'hyp|lbl', field_id)[-1]
@@ -194,28 +1087,282 @@ def fieldKey(x) :
     field = field.rstrip('X21')
     return field
 
-class LegistarAPIScraper(Scraper):
+class LegistarAPIScraper(LegistarSession):
     date_format = '%Y-%m-%dT%H:%M:%S'
+
+    # Paginate with keyset filters on item_key instead of $skip
+    KEYSET_PAGINATION = False
+
+    # Pages to request ahead of the one being consumed
+    PREFETCH_PAGES = 0
+
+    # Full records fetched once per endpoint to estimate what a $select
+    # projection saves
+    PROJECTION_SAMPLE_SIZE = 20
+
+    # Slow changing endpoints, and the key of their items, whose full
+    # lists are kept in the jurisdiction's state file by reference()
+    REFERENCE_ENDPOINTS = {'bodies' : 'BodyId',
+                           'bodytypes' : 'BodyTypeId',
+                           'mattertypes' : 'MatterTypeId',
+                           'matterstatuses' : 'MatterStatusId',
+                           'persons' : 'PersonId'}
+
+    # Seconds a stored reference list is used before it is fetched
+    # again. 0 always fetches
+    REFERENCE_TTL = 60 * 60
+
+    def __init__(self, *args, **kwargs) :
+        super(LegistarAPIScraper, self).__init__(*args, **kwargs)
+        self._full_record_bytes = {}
     
     def toTime(self, text) :
-        time = datetime.datetime.strptime(text, self.date_format)
-        time = pytz.timezone(self.TIMEZONE).localize(time)
-        return time
+        return localTime(text, self.date_format, self.TIMEZONE)
+
+    def pages(self, url, params=None, item_key=None, keyset=None,
+              prefetch=None, fields=None):
+        """
+        Yield every item from a paginated API endpoint.
 
-    def pages(self, url, params=None, item_key=None):
+        With keyset pagination, results are ordered by item_key and
+        each page asks for keys greater than the last one seen. Unlike
+        $skip, that is stable when items are added during the scrape
+        and cheap for the server however deep we go. It falls back to
+        $skip if the endpoint rejects the ordering or ignores it.
+        keyset defaults to the class's KEYSET_PAGINATION.
+
+        prefetch is how many pages to request in the background while
+        the current one is consumed, defaulting to PREFETCH_PAGES. The
+        next keyset page depends on the current one, so keyset
+        pagination prefetches at most one page. With $skip, the first
+        page is fetched alone and nothing more is requested once a
+        short page has come back, so at most prefetch requests go past
+        the end. How often we still had to wait for a prefetched page
+        is in self.stats.
+
+        If fields is given, only those fields (and item_key) are
+        requested, using $select.
+        """
         if params is None:
             params = {}
-        
+
+        if fields :
+            params = dict(params)
+            params['$select'] = ','.join(sorted(set(fields) | {item_key}))
+
+        if keyset is None :
+            keyset = self.KEYSET_PAGINATION
+
+        if prefetch is None :
+            prefetch = self.PREFETCH_PAGES
+
+        if keyset :
+            yield from self._keyset_pages(url, params, item_key, prefetch)
+        else :
+            yield from self._skip_pages(url, params, item_key, prefetch)
+
+    def reference(self, endpoint, fields=None) :
+        """
+        Return every item of endpoint, one of REFERENCE_ENDPOINTS. A
+        list stored less than REFERENCE_TTL seconds ago, by any scraper
+        for this jurisdiction, is used instead of fetching it again.
+        """
+        url = self.BASE_URL + '/{}/'.format(endpoint)
+        item_key = self.REFERENCE_ENDPOINTS[endpoint]
+
+        store = self.state('reference_data')
+        key = url
+        if fields :
+            key += '?$select=' + ','.join(sorted(set(fields) | {item_key}))
+
+        if self.REFERENCE_TTL :
+            stored = store.get(key)
+            if stored and time.time() - stored['fetched'] < self.REFERENCE_TTL :
+                self.count('reference hits ' + endpoint)
+                return stored['items']
+
+        fetched = time.time()
+        items = list(self.pages(url, item_key=item_key, fields=fields))
+        store[key] = {'fetched' : fetched, 'items' : items}
+        self.count('reference misses ' + endpoint)
+
+        return items
+
+    def _skip_pages(self, url, params, item_key, prefetch=0) :
         seen = deque([], maxlen=1000)
 
-        page_num = 0
-        while page_num == 0 or len(response.json()) == 1000 :
-            params['$skip'] = page_num * 1000
-            response = self.get(url, params=params)
+        def skip_params(page_num) :
+            page_params = dict(params)
+            page_params['$skip'] = page_num * 1000
+            return page_params
 
-            for item in response.json() :
+        page_params = (skip_params(page_num) for page_num in itertools.count())
+
+        for page in self._pages_ahead(url, page_params, prefetch,
+                                      is_last=lambda page : len(page) < 1000) :
+            for item in page :
                 if item[item_key] not in seen :
                     yield item
                     seen.append(item[item_key])
 
-            page_num += 1
\ No newline at end of file
+            if len(page) < 1000 :
+                return
+
+    def _keyset_pages(self, url, params, item_key, prefetch=0) :
+        keyset_params = dict(params)
+        keyset_params['$orderby'] = item_key
+        keyset_params['$top'] = 1000
+
+        def next_params(last_key) :
+            next_params = dict(keyset_params)
+            next_params['$filter'] = andFilter(params.get('$filter'),
+                                               '{} gt {}'.format(item_key, last_key))
+            return next_params
+
+        try :
+            page = self._get_json(url, keyset_params)
+        except scrapelib.HTTPError :
+            self.warning('{} does not support $orderby={}, '
+                         'paginating with $skip'.format(url, item_key))
+            yield from self._skip_pages(url, params, item_key, prefetch)
+            return
+
+        keys = [item[item_key] for item in page]
+        if keys != sorted(keys) :
+            self.warning('{} ignored $orderby={}, '
+                         'paginating with $skip'.format(url, item_key))
+            yield from self._skip_pages(url, params, item_key, prefetch)
+            return
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try :
+            while len(page) == 1000 :
+                following = next_params(page[-1][item_key])
+                if executor :
+                    future = executor.submit(self._get_json, url, following)
+
+                yield from page
+
+                if executor :
+                    page = self._prefetched(future)
+                else :
+                    page = self._get_json(url, following)
+
+            yield from page
+
+        finally :
+            if executor :
+                executor.shutdown(wait=False)
+
+    def _pages_ahead(self, url, params_iter, prefetch, is_last=None) :
+        """
+        Yield the JSON pages for each params in params_iter, keeping up
+        to prefetch further requests in flight. Once a page for which
+        is_last(page) is true has come back, no more are requested, so
+        at most prefetch requests go past the end.
+        """
+        params_iter = iter(params_iter)
+        if is_last is None :
+            is_last = lambda page : False
+
+        # Fetch the first page on its own, so a short endpoint costs
+        # one request and reading ahead starts only if there is more
+        for params in params_iter :
+            page = self._get_json(url, params)
+            yield page
+            if is_last(page) :
+                return
+            if prefetch :
+                break
+        else :
+            return
+
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=prefetch)
+        try :
+            end_seen = False
+            while True :
+                end_seen = end_seen or any(future.done()
+                                           and future.exception() is None
+                                           and is_last(future.result())
+                                           for future in pending)
+                while not end_seen and len(pending) < prefetch :
+                    params = next(params_iter, None)
+                    if params is None :
+                        end_seen = True
+                        break
+                    pending.append(executor.submit(self._get_json, url, params))
+
+                if not pending :
+                    return
+
+                page = self._prefetched(pending.popleft())
+                yield page
+                if is_last(page) :
+                    return
+
+        finally :
+            for future in pending :
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _prefetched(self, future) :
+        self.count('prefetched pages')
+        if not future.done() :
+            self.count('prefetch waits')
+            start = time.time()
+            future.result()
+            self.count('prefetch wait seconds', time.time() - start)
+
+        return future.result()
+
+    def _get_json(self, url, params) :
+        response = self.get(url, params=params)
+        page = response.json()
+
+        endpoint = self.endpoint_name(url)
+        self.count('bytes ' + endpoint, len(response.content))
+
+        if '$select' in params :
+            self._check_projection(url, params, page, len(response.content))
+
+        return page
+
+    def _check_projection(self, url, params, page, n_bytes) :
+        """
+        Check that the endpoint honoured $select, and estimate the
+        bytes it saved compared with full records.
+        """
+        endpoint = self.endpoint_name(url)
+        fields = set(params['$select'].split(','))
+
+        if endpoint not in self._full_record_bytes :
+            returned = set().union(*page) if page else fields
+            if returned - fields :
+                self.warning('{} ignored $select, returned {}'.format(
+                    endpoint, ', '.join(sorted(returned - fields))))
+            if fields - returned :
+                self.warning('{} did not return selected fields {}'.format(
+                    endpoint, ', '.join(sorted(fields - returned))))
+
+            # Size up a few full records once, to estimate the savings
+            sample_params = {key : value for key, value in params.items()
+                             if key not in ('$select', '$skip', '$top')}
+            sample_params['$top'] = self.PROJECTION_SAMPLE_SIZE
+            response = self.get(url, params=sample_params)
+            self.count('bytes ' + endpoint, len(response.content))
+            sample = response.json()
+            self._full_record_bytes[endpoint] = (len(response.content) / len(sample)
+                                                 if sample else 0)
+
+        full_bytes = len(page) * self._full_record_bytes[endpoint]
+        self.count('$select bytes saved ' + endpoint,
+                   max(int(full_bytes) - n_bytes, 0))
+
+
+def andFilter(*filters) :
+    """Combine OData $filter expressions, skipping empty ones"""
+    filters = [f for f in filters if f]
+    if len(filters) == 1 :
+        return filters[0]
+    return ' and '.join('({})'.format(f) for f in filters)
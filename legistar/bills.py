@@ -1,15 +1,32 @@
-from .base import LegistarScraper, LegistarAPIScraper
+from .base import LegistarScraper, LegistarAPIScraper, LRUCache, chunked, orderedMap, parseTime, timezone
+from .jsonstream import loadObject
 from pupa.scrape import Scraper
+import scrapelib
 from lxml.etree import tostring
 from collections import deque
 from functools import partialmethod
 import datetime
+import tempfile
 import pytz
-import requests
 
 class LegistarBillScraper(LegistarScraper):
+    # How many legislation and action detail pages to keep parsed
+    DETAIL_CACHE_SIZE = 2
+    ACTION_CACHE_SIZE = 16
+
+    def __init__(self, *args, **kwargs) :
+        super(LegistarBillScraper, self).__init__(*args, **kwargs)
+        self._legislation_details = LRUCache(self.DETAIL_CACHE_SIZE)
+        self._action_pages = LRUCache(self.ACTION_CACHE_SIZE)
+
     def legislation(self, search_text='', created_after=None, 
-                    created_before=None) :
+                    created_before=None, stream=False) :
+        """
+        Yield summaries of the legislation matching the search. With
+        stream=True, the search results are parsed incrementally with
+        streamDataTable rather than loaded as one tree, which keeps
+        memory flat on very large result pages.
+        """
 
         # If legislation is added to the the legistar system while we
         # are scraping, it will shift the list of legislation down and
@@ -18,12 +35,36 @@ class LegistarBillScraper(LegistarScraper):
         # make sure we are not revisiting
         scraped_leg = deque([], maxlen=10)
 
-        for page in self.searchLegislation(search_text, created_after,
-                                           created_before) :
-            for legislation_summary in self.parseSearchResults(page) :
-                if not legislation_summary['url'] in scraped_leg :
-                    yield legislation_summary
-                    scraped_leg.append(legislation_summary['url'])
+        # An unfiltered search continues from the last complete one. The
+        # results do not reliably show when legislation was created, so
+        # the watermark is the day that search started, and we search
+        # from the day before so nothing created later that day is lost
+        incremental = not (search_text or created_after or created_before)
+        if incremental :
+            started = self.now().astimezone(timezone(self.TIMEZONE)).date()
+            watermark = self.watermark('legislation')
+            if watermark :
+                created_after = (parseTime(watermark, '%Y-%m-%d').date()
+                                 - datetime.timedelta(days=1))
+
+        if stream :
+            search_results = self.streamLegislation(search_text,
+                                                    created_after,
+                                                    created_before)
+        else :
+            search_results = (legislation_summary
+                              for page in self.searchLegislation(search_text,
+                                                                 created_after,
+                                                                 created_before)
+                              for legislation_summary in self.parseSearchResults(page))
+
+        for legislation_summary in search_results :
+            if not legislation_summary['url'] in scraped_leg :
+                yield legislation_summary
+                scraped_leg.append(legislation_summary['url'])
+
+        if incremental :
+            self.setWatermark('legislation', started.isoformat())
 
     def searchLegislation(self, search_text='', created_after=None,
                           created_before=None):
@@ -31,7 +72,30 @@ class LegistarBillScraper(LegistarScraper):
         Submit a search query on the legislation search page, and return a list
         of summary results.
         """
+        payload = self._searchPayload(search_text, created_after,
+                                      created_before)
+
+        return self.pages(self.LEGISLATION_URL, payload)
+
+    def streamLegislation(self, search_text='', created_after=None,
+                          created_before=None):
+        """
+        Submit a search query on the legislation search page, and
+        yield summary results as they are read from the response.
+        """
+        payload = self._searchPayload(search_text, created_after,
+                                      created_before)
 
+        search_results = self.streamDataTable(self.LEGISLATION_URL, payload,
+                                              'ctl00_ContentPlaceHolder1_gridMain_ctl00',
+                                              keep_rows=False)
+
+        for legislation, headers, row in search_results :
+            legislation = self._searchResult(legislation, headers)
+            if legislation is not None :
+                yield legislation
+
+    def _searchPayload(self, search_text, created_after, created_before) :
         page = self.lxmlize(self.LEGISLATION_URL)
 
         page = self._advancedSearch(page)
@@ -64,7 +128,7 @@ class LegistarBillScraper(LegistarScraper):
 
         payload.update(self.sessionSecrets(page))
 
-        return self.pages(self.LEGISLATION_URL, payload)
+        return payload
 
     def parseSearchResults(self, page) :
         """Take a page of search results and return a sequence of data
@@ -73,24 +137,29 @@ class LegistarBillScraper(LegistarScraper):
         ('Document ID', 'Document URL', 'Type', 'Status', 'Introduction Date'
         'Passed Date', 'Main Sponsor', 'Title')
         """
-        table = page.xpath("//table[@id='ctl00_ContentPlaceHolder1_gridMain_ctl00']")[0]
+        table = self.xpath(page, 'main_grid')[0]
         for legislation, headers, row in self.parseDataTable(table):
-            # Do legislation search-specific stuff
-            # ------------------------------------
-            # First column should be the ID of the record.
-            id_key = headers[0]
-            try:
-                legislation_id = legislation[id_key]['label']
-            except TypeError:
-                continue
-            legislation_url = legislation[id_key]['url'].split(self.BASE_URL)[-1]
-            legislation[id_key] = legislation_id
-            legislation['url'] = self.BASE_URL + legislation_url.split('&Options')[0] + '&FullText=1'
-
-            yield legislation
+            legislation = self._searchResult(legislation, headers)
+            if legislation is not None :
+                yield legislation
+
+    def _searchResult(self, legislation, headers) :
+        # Do legislation search-specific stuff
+        # ------------------------------------
+        # First column should be the ID of the record.
+        id_key = headers[0]
+        try:
+            legislation_id = legislation[id_key]['label']
+        except TypeError:
+            return None
+        legislation_url = legislation[id_key]['url'].split(self.BASE_URL)[-1]
+        legislation[id_key] = legislation_id
+        legislation['url'] = self.BASE_URL + legislation_url.split('&Options')[0] + '&FullText=1'
+
+        return legislation
 
     def _advancedSearch(self, page) :
-        search_switcher = page.xpath("//input[@id='ctl00_ContentPlaceHolder1_btnSwitch']")[0]
+        search_switcher = self.xpath(page, 'search_switcher')[0]
 
         if 'simple search' in search_switcher.value.lower() :
             return page
@@ -100,7 +169,7 @@ class LegistarBillScraper(LegistarScraper):
 
             page = self.lxmlize(self.LEGISLATION_URL, payload)
 
-            if 'simple search' not in page.xpath("//input[@id='ctl00_ContentPlaceHolder1_btnSwitch']")[0].value.lower() :
+            if 'simple search' not in self.xpath(page, 'search_switcher')[0].value.lower() :
                 raise ValueError('Not on the advanced search page')
 
             return page
@@ -108,35 +177,47 @@ class LegistarBillScraper(LegistarScraper):
     def details(self, detail_url, div_id) :
         detail_page = self.lxmlize(detail_url)
         
-        detail_div = detail_page.xpath(".//div[@id='%s']" % div_id)[0]
+        detail_div = self.xpath(detail_page, 'div_by_id', id=div_id)[0]
 
         return self.parseDetails(detail_div)
 
+    def legislationDetail(self, detail_url) :
+        """
+        Return the LegislationDetail for detail_url. Recently used
+        detail pages are kept, so legDetails, history and text on the
+        same url share a single fetch.
+        """
+        legislation_detail = self._legislation_details.get(detail_url)
+        if legislation_detail is None :
+            legislation_detail = LegislationDetail(self, detail_url)
+            self._legislation_details[detail_url] = legislation_detail
+
+        return legislation_detail
+
     def legDetails(self, detail_url) :
-        div_id = 'ctl00_ContentPlaceHolder1_pageDetails'
-        return self.details(detail_url, div_id)
+        return self.legislationDetail(detail_url).details
 
-    def actionDetails(self, detail_url) :
-        div_id = 'ctl00_ContentPlaceHolder1_pageTop1'
-        return self.details(detail_url, div_id)
+    def actionPage(self, action_detail_url) :
+        """
+        Return the parsed action detail page, shared by actionDetails
+        and extractVotes.
+        """
+        action_detail_page = self._action_pages.get(action_detail_url)
+        if action_detail_page is None :
+            action_detail_page = self.lxmlize(action_detail_url)
+            self._action_pages[action_detail_url] = action_detail_page
 
-    def history(self, detail_url) :
-        detail_page = self.lxmlize(detail_url)
+        return action_detail_page
 
-        try :
-            history_table = detail_page.xpath("//table[@id='ctl00_ContentPlaceHolder1_gridLegislation_ctl00']")[0]
-        except IndexError :
-            print(detail_url)
-            raise
+    def actionDetails(self, detail_url) :
+        action_detail_page = self.actionPage(detail_url)
 
-        history = [row[0] for row in self.parseDataTable(history_table)] 
+        action_detail_div = self.xpath(action_detail_page, 'action_details')[0]
 
-        try :
-            history = sorted(history, key = self._actionSortKey)
-        except (TypeError, ValueError) :
-            pass
+        return self.parseDetails(action_detail_div)
 
-        for action in history :
+    def history(self, detail_url) :
+        for action in self.legislationDetail(detail_url).history :
             yield action
 
                     
@@ -147,37 +228,85 @@ class LegistarBillScraper(LegistarScraper):
         return (action_date, action_url)
 
     def text(self, detail_url) :
-        detail_page = self.lxmlize(detail_url)
-
-        text_div = detail_page.xpath("//div[@id='ctl00_ContentPlaceHolder1_divText']")
-
-        if len(text_div) :
-            return tostring(text_div[0], pretty_print=True).decode()
-        else :
-            return None
-
-        
-        
+        return self.legislationDetail(detail_url).text
 
     def extractVotes(self, action_detail_url) :
-        action_detail_page = self.lxmlize(action_detail_url)
+        action_detail_page = self.actionPage(action_detail_url)
         try:
-            vote_table = action_detail_page.xpath("//table[@id='ctl00_ContentPlaceHolder1_gridVote_ctl00']")[0]
+            vote_table = self.xpath(action_detail_page, 'vote_table')[0]
         except IndexError:
             self.warning("No votes found in table")
             return None, []
-        votes = list(self.parseDataTable(vote_table))
+        votes = list(self.parseDataTable(vote_table, keep_rows=False))
         vote_list = []
         for vote, _, _ in votes :
             raw_option = vote['Vote'].lower()
             vote_list.append((self.VOTE_OPTIONS.get(raw_option, raw_option), 
                               vote['Person Name']['label']))
 
-        action_detail_div = action_detail_page.xpath(".//div[@id='ctl00_ContentPlaceHolder1_pageTop1']")[0]
-        action_details = self.parseDetails(action_detail_div)
+        action_details = self.actionDetails(action_detail_url)
         result = action_details['Result'].lower()
 
         return result, vote_list
+
+
+class LegislationDetail(object) :
+    """
+    A legislation detail page, fetched and parsed once. The details,
+    sorted history and text are extracted lazily from the shared tree.
+    """
+    def __init__(self, scraper, detail_url) :
+        self.scraper = scraper
+        self.url = detail_url
+
+        self._page = None
+        self._details = None
+        self._history = None
+
+    @property
+    def page(self) :
+        if self._page is None :
+            self._page = self.scraper.lxmlize(self.url)
+
+        return self._page
+
+    @property
+    def details(self) :
+        if self._details is None :
+            detail_div = self.scraper.xpath(self.page, 'page_details')[0]
+            self._details = self.scraper.parseDetails(detail_div)
+
+        return self._details
+
+    @property
+    def history(self) :
+        if self._history is None :
+            try :
+                history_table = self.scraper.xpath(self.page, 'history_table')[0]
+            except IndexError :
+                print(self.url)
+                raise
+
+            history = [row[0] for row in self.scraper.parseDataTable(history_table,
+                                                                      keep_rows=False)]
+
+            try :
+                history = sorted(history, key = self.scraper._actionSortKey)
+            except (TypeError, ValueError) :
+                pass
+
+            self._history = history
+
+        return self._history
+
+    @property
+    def text(self) :
+        text_div = self.scraper.xpath(self.page, 'legislation_text')
+
+        if len(text_div) :
+            return tostring(text_div[0], pretty_print=True).decode()
+        else :
+            return None
         
 
 def dateWithin(created_after, created_before) :
@@ -208,41 +337,224 @@ def dateBound(creation_date) :
 
     return payload
 
+def idFilters(key, ids, max_gap, max_length) :
+    """
+    OData $filter expressions matching key to all of ids, as few as
+    possible under max_length characters. Ids at most max_gap apart
+    are merged into ranges. With a max_gap of 1 only consecutive ids
+    are, and the filters match ids exactly; a larger one lets rows for
+    other ids in between match too.
+    """
+    ranges = []
+    for id_ in sorted(set(ids)) :
+        if ranges and id_ - ranges[-1][1] <= max_gap :
+            ranges[-1][1] = id_
+        else :
+            ranges.append([id_, id_])
+
+    clauses = []
+    for low, high in ranges :
+        if low == high :
+            clauses.append('{} eq {}'.format(key, low))
+        else :
+            clauses.append('({0} ge {1} and {0} le {2})'.format(key, low, high))
+
+    odata_filter = ''
+    for clause in clauses :
+        if odata_filter and len(odata_filter) + len(clause) + 4 > max_length :
+            yield odata_filter
+            odata_filter = ''
+        odata_filter = odata_filter + ' or ' + clause if odata_filter else clause
+
+    if odata_filter :
+        yield odata_filter
+
+
 class LegistarAPIBillScraper(LegistarAPIScraper) :
+    # Fields of /matters to request, or None for whole records
+    MATTER_FIELDS = None
+
+    # Matters are handled in batches of this size, so work like
+    # looking up web urls can be done for many matters at once
+    MATTER_BATCH_SIZE = 100
+
+    # Concurrent HEAD requests for matter web urls we have not seen
+    LEGISLATION_URL_WORKERS = 1
+
+    # Matter texts larger than this are spooled to disk while decoding
+    TEXT_SPOOL_SIZE = 8 * 1024 * 1024
+
+    # Per matter sub-resources, and the top level collections that hold
+    # the same rows for every matter: (route, matter id field, row id
+    # field). Collections that fail or ignore the filter fall back to
+    # one request per matter.
+    RELATED_ROUTES = {
+        'history' : '/matters/{0}/histories',
+        'sponsors' : '/matters/{0}/sponsors',
+        'attachments' : '/matters/{0}/attachments',
+        'topics' : '/matters/{0}/indexes',
+        'relations' : '/matters/{0}/relations',
+    }
+    BULK_ROUTES = {
+        'history' : ('/matterhistories', 'MatterHistoryMatterId', 'MatterHistoryId'),
+        'sponsors' : ('/mattersponsors', 'MatterSponsorMatterId', 'MatterSponsorId'),
+        'attachments' : ('/matterattachments', 'MatterAttachmentMatterId', 'MatterAttachmentId'),
+        'topics' : ('/matterindexes', 'MatterIndexMatterId', 'MatterIndexId'),
+        'relations' : ('/matterrelations', 'MatterRelationMatterId', 'MatterRelationId'),
+    }
+
+    # Sub-resources matters() fetches in bulk for each batch of matters
+    BULK_RELATED = ()
+
+    # Bulk $filters match exactly the batch's matter ids, merging only
+    # runs of consecutive ids into ranges. Raising this also merges ids
+    # up to this far apart, which shortens filters but fetches and
+    # discards the rows of the ids in between. Bulk filters are kept
+    # under BULK_MAX_FILTER_LENGTH characters
+    BULK_MAX_GAP = 1
+    BULK_MAX_FILTER_LENGTH = 1500
+
+    def __init__(self, *args, **kwargs) :
+        super(LegistarAPIBillScraper, self).__init__(*args, **kwargs)
+        self._related = {}
+        self._bulk_unsupported = set()
+
     # Make parameter optional, as it is in events.py
-    def matters(self, since_datetime=None) :
+    def matters(self, since_datetime=None, related=None) :
+        """
+        Yield matters, modified since since_datetime if given.
+
+        related names sub-resources, like 'history' or 'sponsors', to
+        fetch with one filtered query per batch of matters rather than
+        one request per matter. It defaults to BULK_RELATED. The
+        per-matter methods then answer from those results.
+        """
+        if related is None :
+            related = self.BULK_RELATED
+
+        started = datetime.datetime.utcnow()
+
         if since_datetime:
-            params = {'$filter' : "MatterLastModifiedUtc gt datetime'{since_datetime}'".format(since_datetime = since_datetime.isoformat())}
+            since = since_datetime.isoformat()
+            incremental = False
+        else:
+            since = self.watermark('matters')
+            incremental = True
+
+        if since:
+            params = {'$filter' : "MatterLastModifiedUtc gt datetime'{since_datetime}'".format(since_datetime = since)}
         else:
             params = {}
         
         matters_url = self.BASE_URL + '/matters'
 
-        for matter in self.pages(matters_url,
-                                 params=params,
-                                 item_key="MatterId"):
-            try:
-                legistar_url = self.legislation_detail_url(matter['MatterId'])
-            except KeyError:
-                continue
-            else:
-                matter['legistar_url'] = legistar_url
+        if self.MATTER_FIELDS :
+            fields = set(self.MATTER_FIELDS) | {'MatterLastModifiedUtc'}
+        else :
+            fields = None
+
+        matters = self.pages(matters_url,
+                             params=params,
+                             item_key="MatterId",
+                             fields=fields)
+
+        # Last modified times of matters we could not yield
+        retry = []
+
+        for batch in chunked(matters, self.MATTER_BATCH_SIZE) :
+            legistar_urls = self.legislation_detail_urls(matter['MatterId']
+                                                         for matter in batch)
+
+            self._related = {}
+            for resource in related :
+                self._related[resource] = self.bulk_related(resource,
+                                                            [matter['MatterId'] for matter in batch])
+
+            for matter in batch :
+                try:
+                    legistar_url = legistar_urls[matter['MatterId']]
+                except KeyError:
+                    if matter['MatterLastModifiedUtc']:
+                        retry.append(matter['MatterLastModifiedUtc'])
+                    continue
+                else:
+                    matter['legistar_url'] = legistar_url
             
-            yield matter
+                yield matter
+
+        if incremental :
+            self.setWatermark('matters', self.runWatermark(started, retry))
+
+    def matter_types(self) :
+        return {matter_type['MatterTypeName'] : matter_type['MatterTypeId']
+                for matter_type in self.reference('mattertypes')}
+
+    def matter_statuses(self) :
+        return {status['MatterStatusName'] : status['MatterStatusId']
+                for status in self.reference('matterstatuses')}
 
     def endpoint(self, route, *args) :
         url = self.BASE_URL + route
         response = self.get(url.format(*args))
         return response.json()
 
-    topics = partialmethod(endpoint, '/matters/{0}/indexes')
-    attachments = partialmethod(endpoint, '/matters/{0}/attachments')
+    def related(self, resource, matter_id) :
+        """
+        Rows of the sub-resource for matter_id, from the bulk results
+        for the current batch of matters if we have them.
+        """
+        rows = self._related.get(resource, {}).get(matter_id)
+        if rows is None :
+            rows = self.endpoint(self.RELATED_ROUTES[resource], matter_id)
+        return rows
+
+    def bulk_related(self, resource, matter_ids) :
+        """
+        Fetch the sub-resource for all of matter_ids with filtered
+        queries on its top level collection, and return the rows
+        grouped by matter id. Returns {} if the API does not support
+        that, so callers fall back to per-matter requests.
+        """
+        if resource in self._bulk_unsupported or resource not in self.BULK_ROUTES :
+            return {}
+
+        route, matter_key, row_key = self.BULK_ROUTES[resource]
+        url = self.BASE_URL + route
+
+        grouped = {matter_id : [] for matter_id in matter_ids}
+        lowest, highest = min(matter_ids), max(matter_ids)
+
+        try :
+            for odata_filter in idFilters(matter_key, matter_ids,
+                                          self.BULK_MAX_GAP,
+                                          self.BULK_MAX_FILTER_LENGTH) :
+                for row in self.pages(url,
+                                      params={'$filter' : odata_filter},
+                                      item_key=row_key) :
+                    if row[matter_key] in grouped :
+                        grouped[row[matter_key]].append(row)
+                    elif not lowest <= row[matter_key] <= highest :
+                        raise ValueError('filter ignored')
+
+        except (scrapelib.HTTPError, KeyError, ValueError) :
+            self.warning('Could not fetch {} in bulk from {}, '
+                         'fetching it per matter'.format(resource, route))
+            self._bulk_unsupported.add(resource)
+            return {}
+
+        self.count('bulk {} queries'.format(resource))
+        return grouped
+
+    topics = partialmethod(related, 'topics')
+    attachments = partialmethod(related, 'attachments')
     code_sections = partialmethod(endpoint, 'matters/{0}/codesections')
-    relations = partialmethod(endpoint, '/matters/{0}/relations')
+    relations = partialmethod(related, 'relations')
 
     def votes(self, history_id) :
         url = self.BASE_URL + '/eventitems/{0}/votes'.format(history_id)
-        response = requests.get(url)
+        # A single uncached attempt first, since retrying the known
+        # server error below would only waste time
+        response = self.rawRequest('GET', url)
         if response.status_code == 200 :
             return response.json()
         elif response.status_code == 500 and response.json().get('InnerException', {}).get('ExceptionMessage', '') == "The cast to value type 'System.Int32' failed because the materialized value is null. Either the result type's generic parameter or the query must use a nullable type." :
@@ -252,7 +564,7 @@ class LegistarAPIBillScraper(LegistarAPIScraper) :
             return response.json()
 
     def history(self, matter_id) :
-        actions = self.endpoint('/matters/{0}/histories', matter_id)
+        actions = self.related('history', matter_id)
         for action in actions:
             action['MatterHistoryActionName'] = action['MatterHistoryActionName'].strip()
 
@@ -266,7 +578,7 @@ class LegistarAPIBillScraper(LegistarAPIScraper) :
         return actions
 
     def sponsors(self, matter_id) :
-        spons = self.endpoint('/matters/{0}/sponsors', matter_id)
+        spons = self.related('sponsors', matter_id)
         if spons:
             max_version = str(max(int(sponsor['MatterSponsorMatterVersion'])
                               for sponsor in spons))
@@ -286,14 +598,78 @@ class LegistarAPIBillScraper(LegistarAPIScraper) :
         latest_version = max(versions, key=lambda x : x['Value'])['Key']
         
         text_url = self.BASE_URL + text_route.format(matter_id, latest_version)
-        response = self.get(text_url, stream=True)
-        if int(response.headers['Content-Length']) < 21052630 :
-            return response.json()
+        with self.uncached() :
+            response = self.get(text_url, stream=True)
+
+        # Texts can be tens of megabytes of RTF. Spool the body to a
+        # temporary file, which only moves to disk for large texts, and
+        # decode it incrementally rather than holding it twice
+        with tempfile.SpooledTemporaryFile(max_size=self.TEXT_SPOOL_SIZE) as body :
+            n_bytes = 0
+            for chunk in response.iter_content(chunk_size=64 * 1024) :
+                body.write(chunk)
+                n_bytes += len(chunk)
+
+            self.count('text bytes', n_bytes)
+            if n_bytes > self.TEXT_SPOOL_SIZE :
+                self.count('texts spooled to disk')
+            self.debug('read {} bytes of text for matter {}'.format(n_bytes, matter_id))
+
+            return loadObject(body, response.encoding or 'utf-8')
 
     def legislation_detail_url(self, matter_id) :
-        gateway_url = self.BASE_WEB_URL + '/gateway.aspx?m=l&id={0}'
-        
-        legislation_detail_route = self.head(gateway_url.format(matter_id)).headers['Location']
+        gateway_url = self.BASE_WEB_URL + '/gateway.aspx?m=l&id={0}'.format(matter_id)
+
+        detail_routes = self.state('legislation_detail_routes')
+
+        legislation_detail_route = detail_routes.get(gateway_url)
+        if legislation_detail_route is None :
+            legislation_detail_route = self.head(gateway_url).headers['Location']
+            # Only keep real detail pages, not a passing redirect to
+            # Error.aspx or a login page
+            if 'LegislationDetail.aspx' in legislation_detail_route :
+                detail_routes[gateway_url] = legislation_detail_route
+            else :
+                self.count('unexpected legislation detail routes')
         
         return self.BASE_WEB_URL + legislation_detail_route
 
+    def legislation_detail_urls(self, matter_ids) :
+        """
+        Return a dict of web urls for matter_ids. Urls we have seen
+        before come from the state file, and the rest are looked up
+        with up to LEGISLATION_URL_WORKERS concurrent HEAD requests.
+        Matters without a detail page are left out.
+        """
+        gateway_url = self.BASE_WEB_URL + '/gateway.aspx?m=l&id={0}'
+        gateway_urls = {matter_id : gateway_url.format(matter_id)
+                        for matter_id in matter_ids}
+
+        detail_routes = self.state('legislation_detail_routes')
+        known_routes = detail_routes.get_many(gateway_urls.values())
+
+        detail_urls = {}
+        unknown = []
+        for matter_id, url in gateway_urls.items() :
+            if url in known_routes :
+                detail_urls[matter_id] = self.BASE_WEB_URL + known_routes[url]
+            else :
+                unknown.append(matter_id)
+
+        def lookup(matter_id) :
+            try :
+                return matter_id, self.legislation_detail_url(matter_id)
+            except KeyError :
+                return matter_id, None
+
+        if self.LEGISLATION_URL_WORKERS > 1 :
+            looked_up = orderedMap(lookup, unknown, self.LEGISLATION_URL_WORKERS)
+        else :
+            looked_up = map(lookup, unknown)
+
+        for matter_id, detail_url in looked_up :
+            if detail_url is not None :
+                detail_urls[matter_id] = detail_url
+
+        return detail_urls
+
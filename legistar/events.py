@@ -1,3 +1,4 @@
+import re
 import time
 import datetime
 from collections import deque
@@ -5,19 +6,18 @@ from collections import deque
 import lxml.html
 import pytz
 import icalendar
-import requests
 from pupa.scrape import Scraper
 import scrapelib
 
-from .base import LegistarScraper, LegistarAPIScraper
+from .base import LegistarScraper, LegistarAPIScraper, LRUCache, orderedMap, parseTime, timezone
 
 
 class LegistarEventsScraper(LegistarScraper):
     def eventPages(self, since) :
-        # Directly use the requests library here, so that we do not
-        # use a cached page, which may have expired .NET state values,
-        # even in fastmode (which uses the cache).
-        response = requests.get(self.EVENTSPAGE, verify=False)
+        # Skip scrapelib's cache here, so that we do not use a cached
+        # page, which may have expired .NET state values, even in
+        # fastmode (which uses the cache).
+        response = self.rawRequest('GET', self.EVENTSPAGE, verify=False)
         self._check_errors(response)
         entry = response.text
         page = lxml.html.fromstring(entry)
@@ -25,7 +25,7 @@ class LegistarEventsScraper(LegistarScraper):
 
         if since is None :
             for page in self.eventSearch(page, 'All'):
-                time_range, = page.xpath("//input[@id='ctl00_ContentPlaceHolder1_lstYears_Input']")
+                time_range, = self.xpath(page, 'years_input')
                 time_range = time_range.value
                 assert time_range == "All Years"
                 yield page
@@ -42,7 +42,34 @@ class LegistarEventsScraper(LegistarScraper):
 
         return self.pages(self.EVENTSPAGE, payload)
 
-    def events(self, follow_links=True, since=None) :
+    def events(self, follow_links=True, since=None, max_workers=None) :
+        """
+        Yield (event, agenda) for every row of the events calendar.
+
+        If max_workers is set, meeting detail and agenda pages are
+        fetched by a pool of that many threads. Results are still
+        yielded in calendar order, each agenda is a list rather than a
+        generator, and requests_per_minute applies across all workers.
+        """
+        event_rows = self._eventRows(follow_links, since)
+
+        if follow_links and max_workers :
+            yield from orderedMap(self._eventWithAgenda,
+                                  event_rows,
+                                  max_workers)
+        else :
+            for event, detail_url in event_rows :
+                if detail_url :
+                    meeting_details = self.lxmlize(detail_url)
+
+                    agenda = self.agenda(detail_url, meeting_details)
+
+                else :
+                    agenda = None
+
+                yield event, agenda
+
+    def _eventRows(self, follow_links, since) :
         # If an event is added to the the legistar system while we
         # are scraping, it will shift the list of events down and
         # we might revisit the same event. So, we keep track of
@@ -52,7 +79,7 @@ class LegistarEventsScraper(LegistarScraper):
 
         for page in self.eventPages(since) :
 
-            events_table = page.xpath("//table[@class='rgMasterTable']")[0]
+            events_table = self.xpath(page, 'master_table')[0]
             for event, _, _ in self.parseDataTable(events_table) :
                 if follow_links and type(event["Meeting Details"]) == dict :
                     detail_url = event["Meeting Details"]['url']
@@ -61,26 +88,42 @@ class LegistarEventsScraper(LegistarScraper):
                     else :
                         scraped_events.append(detail_url)
 
-                    meeting_details = self.lxmlize(detail_url)
+                    # Should always equal stats['GET MeetingDetail.aspx']
+                    self.count('meetings')
+                else :
+                    detail_url = None
 
-                    agenda = self.agenda(detail_url)
+                yield event, detail_url
 
-                else :
-                    agenda = None
-                
-                yield event, agenda
+    def _eventWithAgenda(self, event_row) :
+        event, detail_url = event_row
 
-    def agenda(self, detail_url) :
-        page = self.lxmlize(detail_url)
+        if detail_url :
+            meeting_details = self.lxmlize(detail_url)
 
-        payload = self.sessionSecrets(page)
+            agenda = list(self.agenda(detail_url, meeting_details))
+
+        else :
+            agenda = None
+
+        return event, agenda
+
+    def agenda(self, detail_url, detail_page=None) :
+        """
+        Page through the agenda grid of a meeting. If the meeting detail
+        page has already been fetched, pass it as detail_page so its
+        session secrets are reused instead of fetching it again.
+        """
+        if detail_page is None :
+            detail_page = self.lxmlize(detail_url)
+
+        payload = self.sessionSecrets(detail_page)
 
         payload.update({"__EVENTARGUMENT": "3:1",
                         "__EVENTTARGET":"ctl00$ContentPlaceHolder1$menuMain"})
         
         for page in self.pages(detail_url, payload) :
-            agenda_table = page.xpath(
-                "//table[@id='ctl00_ContentPlaceHolder1_gridMain_ctl00']")[0]
+            agenda_table = self.xpath(page, 'main_grid')[0]
             agenda = self.parseDataTable(agenda_table)
             yield from agenda
 
@@ -96,11 +139,11 @@ class LegistarEventsScraper(LegistarScraper):
     def extractRollCall(self, action_detail_url) :
         action_detail_page = self.lxmlize(action_detail_url)
         try:
-            rollcall_table = action_detail_page.xpath("//table[@id='ctl00_ContentPlaceHolder1_gridRollCall_ctl00']")[0]
+            rollcall_table = self.xpath(action_detail_page, 'rollcall_table')[0]
         except IndexError:
             self.warning("No rollcall found in table")
             return []
-        roll_call = list(self.parseDataTable(rollcall_table))
+        roll_call = list(self.parseDataTable(rollcall_table, keep_rows=False))
         call_list = []
         for call, _, _ in roll_call :
             option = call['Attendance']
@@ -117,20 +160,69 @@ class LegistarEventsScraper(LegistarScraper):
 
 
 class LegistarAPIEventScraper(LegistarAPIScraper):
+    # Fields of /events to request, or None for whole records
+    EVENT_FIELDS = None
+
+    # Events whose items are kept, so that agenda() and rollcalls() for
+    # the same event share one request
+    EVENT_ITEMS_CACHE_SIZE = 16
+
+    def __init__(self, *args, **kwargs):
+        super(LegistarAPIEventScraper, self).__init__(*args, **kwargs)
+        self._event_items = LRUCache(self.EVENT_ITEMS_CACHE_SIZE)
 
     def events(self, since_datetime=None):
+        started = datetime.datetime.utcnow()
+
         if since_datetime:
-            params = {'$filter' : "EventLastModifiedUtc gt datetime'{since_datetime}'".format(since_datetime = since_datetime.isoformat())}
+            since_modified = since_datetime.isoformat()
+            incremental = False
+        else:
+            since_modified = self.watermark('events')
+            incremental = True
+
+        if since_modified:
+            params = {'$filter' : "EventLastModifiedUtc gt datetime'{since_datetime}'".format(since_datetime = since_modified)}
         else:
             params = {}
 
         events_url = self.BASE_URL + '/events/'
 
-        web_results = self._scrapeWebCalendar()
-
-        for api_event in self.pages(events_url,
-                                    params=params,
-                                    item_key="EventId"):
+        if self.EVENT_FIELDS :
+            # Fields we need to match API events with the web calendar,
+            # and to keep the watermark
+            fields = set(self.EVENT_FIELDS) | {'EventDate',
+                                               'EventTime',
+                                               'EventBodyName',
+                                               'EventLastModifiedUtc'}
+        else :
+            fields = None
+
+        api_events = self.pages(events_url,
+                                params=params,
+                                item_key="EventId",
+                                fields=fields)
+
+        since = None
+        if since_modified:
+            # Only a few events will have changed. Hold them, so the web
+            # calendar can be limited to the years they fall in
+            api_events = list(api_events)
+            years = {self.toTime(api_event['EventDate']).year
+                     for api_event in api_events}
+            # The year search stops at this year, so later events need
+            # the full calendar
+            if years and max(years) <= datetime.date.today().year:
+                since = min(years)
+
+        # Scraped when the first event needs it
+        web_results = None
+
+        # Last modified times of events missing from the web calendar,
+        # which may not have caught up yet
+        retry = []
+
+        for api_event in api_events:
             start = self.toTime(api_event['EventDate'])
             # EventTime may be 'None': this try-except block catches those instances.
             try:
@@ -145,37 +237,56 @@ class LegistarAPIEventScraper(LegistarAPIScraper):
                 key = (api_event['EventBodyName'].strip(),
                        api_event['start'])
 
+                if web_results is None:
+                    web_results = self._scrapeWebCalendar(since)
+
                 try:
                     web_event = web_results[key]
                     yield api_event, web_event
                 except KeyError:
+                    if api_event['EventLastModifiedUtc']:
+                        retry.append(api_event['EventLastModifiedUtc'])
                     continue
+
+        if incremental:
+            self.setWatermark('events', self.runWatermark(started, retry))
             
 
     def agenda(self, event):
-        agenda_url = self.BASE_URL + '/events/{}/eventitems'.format(event['EventId'])
-
-        response = self.get(agenda_url)
+        items = [item for item in self.eventItems(event)
+                 if item['EventItemTitle']]
 
         try:
             # Order the event items according to the EventItemMinutesSequence. If an 
             # event item does not have a value for EventItemMinutesSequence, the script 
             #will throw a TypeError. In that case, try to order by EventItemAgendaSequence.
-            filtered_response = sorted((item for item in response.json() 
-                                        if item['EventItemTitle']), 
+            filtered_response = sorted(items,
                                        key = lambda item : item['EventItemMinutesSequence'])
         except TypeError:
             try:
-                filtered_response = sorted((item for item in response.json() 
-                                            if item['EventItemTitle']), 
+                filtered_response = sorted(items,
                                            key = lambda item : item['EventItemAgendaSequence'])
             except TypeError:
-                filtered_response = (item for item in response.json() 
-                                     if item['EventItemTitle'])
+                filtered_response = items
 
         for item in filtered_response:
             yield item
 
+    def eventItems(self, event):
+        """
+        The decoded /eventitems of event, from the cache if agenda() or
+        rollcalls() has fetched them recently.
+        """
+        event_id = event['EventId']
+        items = self._event_items.get(event_id)
+        if items is None:
+            agenda_url = self.BASE_URL + '/events/{}/eventitems'.format(event_id)
+            items = self.get(agenda_url).json()
+            self.count('GET ' + self.endpoint_name(agenda_url))
+            self._event_items[event_id] = items
+
+        return items
+
     def rollcalls(self, event):
         for item in self.agenda(event):
             if item['EventItemRollCallFlag']:
@@ -186,7 +297,7 @@ class LegistarAPIEventScraper(LegistarAPIScraper):
                 for item in response.json():
                     yield item
 
-    def _scrapeWebCalendar(self):
+    def _scrapeWebCalendar(self, since=None):
         web_scraper = LegistarEventsScraper(self.jurisdiction,
                                             self.datadir,
                                             strict_validation=self.strict_validation,
@@ -197,20 +308,72 @@ class LegistarAPIEventScraper(LegistarAPIScraper):
         web_scraper.date_format = '%m/%d/%Y'
 
         web_info = {}
+        ical_starts = self.state('ical_starts')
 
-        for event, _ in web_scraper.events(follow_links=False):
-            # Make the dict key (name, datetime.datetime), and add it.
-            response = self.get(event['iCalendar']['url'], verify=False)
-            web_scraper._check_errors(response)
-            event_time = web_scraper.ical(response.text).subcomponents[0]['DTSTART'].dt
-            event_time = pytz.timezone(self.TIMEZONE).localize(event_time)
+        for event, _ in web_scraper.events(follow_links=False, since=since):
+            event_time = self._gridStart(event)
+            if event_time is None:
+                event_time = self._icalStart(web_scraper, event, ical_starts)
 
+            # Make the dict key (name, datetime.datetime), and add it.
             key = (event['Name']['label'],
                    event_time)
             web_info[key] = event
 
         return web_info
 
+    def _gridStart(self, event):
+        """
+        The start of a web calendar row, from its Meeting Date and
+        Meeting Time columns, or None if they are missing or are not a
+        date and time.
+        """
+        date = event.get('Meeting Date')
+        start_time = event.get('Meeting Time')
+        if not isinstance(date, str) or not isinstance(start_time, str):
+            return None
+
+        try:
+            date = parseTime(date.strip(), '%m/%d/%Y')
+            start_time = time.strptime(start_time.strip(), '%I:%M %p')
+        except ValueError:
+            return None
+
+        self.count('web event times from grid')
+        event_time = date.replace(hour=start_time.tm_hour,
+                                  minute=start_time.tm_min)
+        return timezone(self.TIMEZONE).localize(event_time)
+
+    def _icalStart(self, web_scraper, event, ical_starts):
+        """
+        The start of a web calendar row, from the DTSTART of its
+        iCalendar file. The iCalendar url stays the same when a meeting
+        is rescheduled, so only starts of past meetings, which will not
+        move, are kept in the jurisdiction's state.
+        """
+        ical_url = event['iCalendar']['url']
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+
+        kept = ical_starts.get(ical_url)
+        if kept is not None:
+            event_time = timezone(self.TIMEZONE).localize(parseTime(kept, '%Y-%m-%dT%H:%M:%S'))
+            if event_time < now:
+                return event_time
+
+        response = self.get(ical_url, verify=False)
+        web_scraper._check_errors(response)
+        self.count('web event times from ical')
+
+        event_time = dtstart(response.text)
+        if event_time is None:
+            event_time = web_scraper.ical(response.text).subcomponents[0]['DTSTART'].dt
+        event_time = timezone(self.TIMEZONE).localize(event_time)
+
+        if event_time < now:
+            ical_starts[ical_url] = event_time.strftime('%Y-%m-%dT%H:%M:%S')
+
+        return event_time
+
     def addDocs(self, e, events, doc_type):
         try :
             if events[doc_type] != 'Not\xa0available':
@@ -221,6 +384,21 @@ class LegistarAPIEventScraper(LegistarAPIScraper):
             pass
 
 
+# A DTSTART property with a local date and time, e.g.
+# DTSTART:20170109T100000
+DTSTART = re.compile(r'^DTSTART(?:;[^:\r\n]*)?:(\d{8}T\d{6})\r?$', re.MULTILINE)
+
+def dtstart(ical_text) :
+    """
+    The local start time of an iCalendar event, read from its DTSTART
+    line without parsing the whole calendar. None if DTSTART is missing
+    or is not a local date and time.
+    """
+    match = DTSTART.search(ical_text)
+    if match is None or 'TZID=' in match.group(0) :
+        return None
+    return datetime.datetime.strptime(match.group(1), '%Y%m%dT%H%M%S')
+
     
 def confirmed_or_passed(when) :
     if datetime.datetime.utcnow().replace(tzinfo = pytz.utc) > when :
@@ -0,0 +1,173 @@
+"""
+Incremental decoding of flat JSON objects, like the matter texts served
+by the Legistar API, which can be tens of megabytes of escaped RTF.
+
+json.load reads the whole document into one string before decoding it,
+so a large text is held twice, raw and decoded. loadObject reads the
+file a chunk at a time and decodes string values piece by piece, so
+only the decoded values are held.
+"""
+import io
+import json
+import re
+
+
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_SCALAR = re.compile(r'[^,}\] \t\n\r]*')
+_HIGH_SURROGATE = re.compile(r'\\u[dD][89abAB][0-9a-fA-F]{2}$')
+
+
+class NotFlat(ValueError) :
+    pass
+
+
+def loadObject(fp, encoding='utf-8') :
+    """
+    Decode the JSON object in the binary file fp. Objects whose values
+    are all strings, numbers, booleans or null are decoded
+    incrementally. Anything else is handed to json.load.
+    """
+    fp.seek(0)
+    text_file = io.TextIOWrapper(fp, encoding=encoding)
+    try :
+        return _Reader(text_file).object()
+    except NotFlat :
+        text_file.seek(0)
+        return json.load(text_file)
+    finally :
+        # Leave fp open for the caller
+        text_file.detach()
+
+
+class _Reader(object) :
+    def __init__(self, text_file) :
+        self.text_file = text_file
+        self.buffer = ''
+        self.pos = 0
+
+    def fill(self, n=1) :
+        """Make sure at least n characters are buffered after pos"""
+        while len(self.buffer) - self.pos < n :
+            chunk = self.text_file.read(CHUNK_SIZE)
+            if not chunk :
+                raise ValueError('Unexpected end of JSON document')
+            self.buffer = self.buffer[self.pos:] + chunk
+            self.pos = 0
+
+    def skip_whitespace(self) :
+        while True :
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) :
+                return
+            self.fill()
+
+    def expect(self, char) :
+        self.skip_whitespace()
+        if self.buffer[self.pos] != char :
+            raise ValueError('Expected {!r} at {!r}'.format(char, self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def object(self) :
+        self.expect('{')
+        result = {}
+
+        self.skip_whitespace()
+        if self.buffer[self.pos] == '}' :
+            self.pos += 1
+            return result
+
+        while True :
+            self.expect('"')
+            key = self.string()
+            self.expect(':')
+            result[key] = self.value()
+
+            self.skip_whitespace()
+            char = self.buffer[self.pos]
+            self.pos += 1
+            if char == '}' :
+                return result
+            elif char != ',' :
+                raise ValueError('Expected , or }} but found {!r}'.format(char))
+
+    def value(self) :
+        self.skip_whitespace()
+        char = self.buffer[self.pos]
+        if char == '"' :
+            self.pos += 1
+            return self.string()
+        elif char in '{[' :
+            raise NotFlat()
+        else :
+            return self.scalar()
+
+    def scalar(self) :
+        token = ''
+        while True :
+            end = _SCALAR.match(self.buffer, self.pos).end()
+            token += self.buffer[self.pos:end]
+            self.pos = end
+            if end < len(self.buffer) :
+                return json.loads(token)
+            self.fill()
+
+    def string(self) :
+        """Decode a string whose opening quote has been read"""
+        parts = []
+        while True :
+            end = self.closing_quote()
+            if end is not None :
+                parts.append(_decode(self.buffer[self.pos:end]))
+                self.pos = end + 1
+                return ''.join(parts)
+
+            # Decode as much as we safely can, and read some more
+            cut = self.safe_cut()
+            if cut > self.pos :
+                parts.append(_decode(self.buffer[self.pos:cut]))
+                self.pos = cut
+            self.fill(len(self.buffer) - self.pos + 1)
+
+    def closing_quote(self) :
+        """The index of the unescaped quote ending the current string"""
+        start = self.pos
+        while True :
+            quote = self.buffer.find('"', start)
+            if quote == -1 :
+                return None
+
+            backslash = quote
+            while backslash > self.pos and self.buffer[backslash - 1] == '\\' :
+                backslash -= 1
+
+            if (quote - backslash) % 2 == 0 :
+                return quote
+            start = quote + 1
+
+    def safe_cut(self) :
+        """
+        An index in the buffer that does not split an escape sequence
+        or a surrogate pair. Escapes are at most 12 characters long.
+        """
+        cut = len(self.buffer) - 12
+        backslash = self.buffer.rfind('\\', max(self.pos, cut - 11), cut)
+        if backslash == -1 :
+            return max(cut, self.pos)
+
+        # Back up to the start of the run of backslashes, which is the
+        # start of an escape
+        while backslash > self.pos and self.buffer[backslash - 1] == '\\' :
+            backslash -= 1
+        cut = backslash
+
+        # Don't separate a high surrogate from the low one after it
+        if _HIGH_SURROGATE.match(self.buffer, max(self.pos, cut - 6), cut) :
+            cut -= 6
+
+        return max(cut, self.pos)
+
+
+def _decode(raw) :
+    return json.loads('"' + raw + '"')
@@ -1,7 +1,7 @@
 import datetime
 import pytz
 
-from .base import LegistarScraper, LegistarAPIScraper
+from .base import LegistarScraper, LegistarAPIScraper, LRUCache
 from pupa.scrape import Scraper
 
 class LegistarPersonScraper(LegistarScraper):
@@ -20,25 +20,22 @@ class LegistarPersonScraper(LegistarScraper):
             payload['__EVENTARGUMENT'] = self.ALL_MEMBERS
 
         for page in self.pages(self.MEMBERLIST, payload) :
-            table = page.xpath(
-                "//table[@id='ctl00_ContentPlaceHolder1_gridPeople_ctl00']")[0]
+            table = self.xpath(page, 'people_table')[0]
 
             for councilman, headers, row in self.parseDataTable(table):
                 if follow_links and type(councilman['Person Name']) == dict:
 
                     detail_url = councilman['Person Name']['url']
                     councilman_details = self.lxmlize(detail_url)
-                    detail_div = councilman_details.xpath(".//div[@id='ctl00_ContentPlaceHolder1_pageDetails']")[0]
+                    detail_div = self.xpath(councilman_details, 'page_details')[0]
 
                     councilman.update(self.parseDetails(detail_div))
 
-                    img = councilman_details.xpath(
-                        "//img[@id='ctl00_ContentPlaceHolder1_imgPhoto']")
+                    img = self.xpath(councilman_details, 'photo')
                     if img :
                         councilman['Photo'] = img[0].get('src')
 
-                    committee_table = councilman_details.xpath(
-                        "//table[@id='ctl00_ContentPlaceHolder1_gridDepartments_ctl00']")[0]
+                    committee_table = self.xpath(councilman_details, 'committee_table')[0]
                     committees = self.parseDataTable(committee_table)
 
                     yield councilman, committees
@@ -49,19 +46,35 @@ class LegistarPersonScraper(LegistarScraper):
 class LegistarAPIPersonScraper(LegistarAPIScraper):
     date_format = '%Y-%m-%dT%H:%M:%S'
 
-    def body_types(self):
-        body_types_url = self.BASE_URL + '/bodytypes/'
-        response = self.get(body_types_url)
+    # Fields of /bodies to request, or None for whole records
+    BODY_FIELDS = None
+
+    # Persons looked up one at a time that are kept, since the same
+    # person holds many offices
+    PERSON_CACHE_SIZE = 512
+
+    # Load every person with one paginated sweep of /persons the first
+    # time a person is needed, instead of fetching them one at a time.
+    # Worth it when most persons will be looked up
+    PRELOAD_PERSONS = False
+
+    # Fields of /persons to request in the sweep, or None for whole
+    # records
+    PERSON_FIELDS = None
+
+    def __init__(self, *args, **kwargs):
+        super(LegistarAPIPersonScraper, self).__init__(*args, **kwargs)
+        self._persons = LRUCache(self.PERSON_CACHE_SIZE)
+        self._person_index = None
 
+    def body_types(self):
         types = {body_type['BodyTypeName'] : body_type['BodyTypeId']
-                 for body_type in response.json()}
+                 for body_type in self.reference('bodytypes')}
 
         return types
 
     def bodies(self):
-        bodies_url = self.BASE_URL + '/bodies/'
-
-        for body in self.pages(bodies_url, item_key="BodyId"):
+        for body in self.reference('bodies', fields=self.BODY_FIELDS):
             yield body
 
     def body_offices(self, body):
@@ -75,12 +88,44 @@ class LegistarAPIPersonScraper(LegistarAPIScraper):
     def toDate(self, text) :
         return self.toTime(text).date()
 
+    def persons(self):
+        if self.PERSON_FIELDS :
+            fields = set(self.PERSON_FIELDS) | {'PersonGuid'}
+        else :
+            fields = None
+
+        for person in self.reference('persons', fields=fields):
+            yield person
+
+    def person(self, person_id):
+        """
+        The /persons record of person_id, from the index of all persons
+        if PRELOAD_PERSONS is set, or else from the cache or the API.
+        """
+        if self.PRELOAD_PERSONS :
+            if self._person_index is None :
+                self._person_index = {person['PersonId'] : person
+                                      for person in self.persons()}
+            try :
+                return self._person_index[person_id]
+            except KeyError :
+                # Added since the sweep
+                pass
+
+        person = self._persons.get(person_id)
+        if person is None :
+            person_api_url = self.BASE_URL + '/persons/{}'.format(person_id)
+            person = self.get(person_api_url).json()
+            self.count('GET ' + self.endpoint_name(person_api_url))
+            self._persons[person_id] = person
+
+        return person
+
     def person_sources_from_office(self, office):
         person_api_url = self.BASE_URL + '/persons/{OfficeRecordPersonId}'.format(**office)
-        
-        response = self.get(person_api_url)
-        person_web_url = self.WEB_URL + '/PersonDetail.aspx?ID={PersonId}&GUID={PersonGuid}'.format(**response.json())
+
+        person = self.person(office['OfficeRecordPersonId'])
+        person_web_url = self.WEB_URL + '/PersonDetail.aspx?ID={PersonId}&GUID={PersonGuid}'.format(**person)
 
         return person_api_url, person_web_url
 
-    
@@ -0,0 +1,155 @@
+"""
+Run the scrapers of many jurisdictions at once.
+
+Each jurisdiction is usually scraped in its own process, one scraper
+after another, so a nightly run takes as long as all the cities put
+together. schedule runs (jurisdiction, scraper) jobs in a pool of
+threads instead, and caps how many requests go to one host at a time,
+since every API scraper shares webapi.legistar.com:
+
+    reports = schedule([(Chicago, 'bills'), (Chicago, 'events'),
+                        (Sacramento, 'people')],
+                       max_workers=8)
+
+Jobs write their output where pupa update would, so pupa update
+--import can load it afterwards. From the command line, jurisdictions
+are given as module:Class with the scraper types to run:
+
+    python -m legistar.scheduler sacramento:Sacramento:people \\
+        legistar.cities.chicago:Chicago:people --workers 8 \\
+        --host-limit webapi.legistar.com=4
+"""
+import argparse
+import glob
+import importlib
+import os
+import sys
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from pupa import settings
+from pupa.scrape import JurisdictionScraper
+
+from .base import limitHost
+
+
+# Requests allowed to one host at once, across all jobs
+HOST_LIMITS = {'webapi.legistar.com' : 4}
+
+
+def schedule(jobs, max_workers=4, host_limits=None, fastmode=False,
+             strict_validation=True) :
+    """
+    Run each (jurisdiction class, scraper type) job, or (jurisdiction
+    class, scraper type, scrape kwargs), in a pool of max_workers
+    threads. host_limits caps concurrent requests per host, defaulting
+    to HOST_LIMITS.
+
+    Returns a report for each job, in the order given, with its pupa
+    scrape record, objects scraped and objects per second, or the
+    traceback if it failed.
+    """
+    if host_limits is None :
+        host_limits = HOST_LIMITS
+    for host, max_concurrent in host_limits.items() :
+        limitHost(host, max_concurrent)
+
+    jobs = [job if len(job) == 3 else (job[0], job[1], {}) for job in jobs]
+
+    # Like pupa update, clear old output and scrape each jurisdiction's
+    # own record before its scrapers run
+    jurisdictions = OrderedDict()
+    for jurisdiction_class, _, _ in jobs :
+        if jurisdiction_class not in jurisdictions :
+            jurisdiction = jurisdiction_class()
+            datadir = prepareDatadir(jurisdiction)
+            JurisdictionScraper(jurisdiction, datadir,
+                                strict_validation=strict_validation,
+                                fastmode=fastmode).do_scrape()
+            jurisdictions[jurisdiction_class] = (jurisdiction, datadir)
+
+    def run(job) :
+        jurisdiction_class, scraper_type, scrape_kwargs = job
+        jurisdiction, datadir = jurisdictions[jurisdiction_class]
+
+        report = {'jurisdiction' : jurisdiction.name,
+                  'scraper' : scraper_type}
+
+        start = time.time()
+        try :
+            scraper_class = jurisdiction.scrapers[scraper_type]
+            scraper = scraper_class(jurisdiction, datadir,
+                                    strict_validation=strict_validation,
+                                    fastmode=fastmode)
+            report['record'] = scraper.do_scrape(**scrape_kwargs)
+        except Exception :
+            report['error'] = traceback.format_exc()
+            report['objects'] = 0
+        else :
+            report['objects'] = sum(report['record']['objects'].values())
+        report['seconds'] = time.time() - start
+        report['objects per second'] = report['objects'] / max(report['seconds'], 1e-9)
+
+        return report
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor :
+        return list(executor.map(run, jobs))
+
+
+def prepareDatadir(jurisdiction) :
+    """
+    The directory pupa update uses for jurisdiction's scraped data,
+    emptied of earlier output.
+    """
+    module = type(jurisdiction).__module__.split('.')[-1]
+    datadir = os.path.join(settings.SCRAPED_DATA_DIR, module)
+    os.makedirs(settings.CACHE_DIR, exist_ok=True)
+    os.makedirs(datadir, exist_ok=True)
+
+    for filename in glob.glob(os.path.join(datadir, '*.json')) :
+        os.remove(filename)
+
+    return datadir
+
+
+def main(argv=None) :
+    parser = argparse.ArgumentParser(description='Scrape many Legistar jurisdictions at once')
+    parser.add_argument('jobs', nargs='+', metavar='module:Class:scraper[,scraper]',
+                        help='a jurisdiction class and the scraper types to run')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--host-limit', action='append', default=[], metavar='HOST=N',
+                        help='concurrent requests allowed to HOST')
+    parser.add_argument('--fastmode', action='store_true')
+    parser.add_argument('--nostrict', action='store_false', dest='strict')
+    args = parser.parse_args(argv)
+
+    jobs = []
+    for spec in args.jobs :
+        module_name, class_name, scraper_types = spec.split(':')
+        jurisdiction_class = getattr(importlib.import_module(module_name), class_name)
+        for scraper_type in scraper_types.split(',') :
+            jobs.append((jurisdiction_class, scraper_type))
+
+    host_limits = dict(HOST_LIMITS)
+    for limit in args.host_limit :
+        host, max_concurrent = limit.split('=')
+        host_limits[host] = int(max_concurrent)
+
+    start = time.time()
+    reports = schedule(jobs, args.workers, host_limits,
+                       fastmode=args.fastmode, strict_validation=args.strict)
+
+    for report in reports :
+        print('{jurisdiction:30} {scraper:10} {objects:8} objects '
+              '{seconds:9.1f} s {objects per second:8.2f} objects/s'.format(**report))
+        if 'error' in report :
+            print(report['error'])
+    print('total wall clock: {:.1f} s'.format(time.time() - start))
+
+    return 1 if any('error' in report for report in reports) else 0
+
+
+if __name__ == '__main__' :
+    sys.exit(main())
@@ -0,0 +1,218 @@
+"""
+Persistent state kept between scraper runs, such as the web URL of each
+matter, and archives of HTTP responses.
+
+Each jurisdiction gets one sqlite file, and each kind of state is a
+table in it. Tables are shared by every scraper in the process that
+opens the same file.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections.abc import MutableMapping
+
+import requests
+
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def connect(path) :
+    """Return the process wide sqlite connection and lock for path."""
+    path = os.path.abspath(path)
+    with _connections_lock :
+        if path not in _connections :
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            connection = sqlite3.connect(path, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            _connections[path] = (connection, threading.RLock())
+
+        return _connections[path]
+
+
+class SqliteStore(MutableMapping) :
+    """
+    A persistent mapping from strings to JSON-serializable values,
+    stored in one table of a sqlite file. Every write is committed
+    immediately.
+    """
+    def __init__(self, path, table) :
+        self.path = path
+        self.table = table
+        self._connection, self._lock = connect(path)
+
+        with self._lock, self._connection :
+            self._connection.execute('CREATE TABLE IF NOT EXISTS "{}" '
+                                     '(key TEXT PRIMARY KEY, value TEXT)'.format(table))
+
+    def _execute(self, sql, parameters=()) :
+        with self._lock, self._connection :
+            return self._connection.execute(sql.format(table=self.table),
+                                            parameters).fetchall()
+
+    def __getitem__(self, key) :
+        rows = self._execute('SELECT value FROM "{table}" WHERE key = ?', (key,))
+        if not rows :
+            raise KeyError(key)
+        return json.loads(rows[0][0])
+
+    def __setitem__(self, key, value) :
+        self._execute('INSERT OR REPLACE INTO "{table}" (key, value) VALUES (?, ?)',
+                      (key, json.dumps(value)))
+
+    def __delitem__(self, key) :
+        if key not in self :
+            raise KeyError(key)
+        self._execute('DELETE FROM "{table}" WHERE key = ?', (key,))
+
+    def __contains__(self, key) :
+        return bool(self._execute('SELECT 1 FROM "{table}" WHERE key = ?', (key,)))
+
+    def __iter__(self) :
+        for key, in self._execute('SELECT key FROM "{table}"') :
+            yield key
+
+    def __len__(self) :
+        return self._execute('SELECT COUNT(*) FROM "{table}"')[0][0]
+
+    def update(self, other=(), **kwargs) :
+        """Write many items in one transaction."""
+        items = dict(other, **kwargs)
+        with self._lock, self._connection :
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO "{}" (key, value) VALUES (?, ?)'.format(self.table),
+                ((key, json.dumps(value)) for key, value in items.items()))
+
+    def get_many(self, keys) :
+        """Return a dict of the stored values for those of keys we have."""
+        keys = list(keys)
+        found = {}
+        # Stay well below sqlite's limit on query parameters
+        for i in range(0, len(keys), 500) :
+            batch = keys[i:i + 500]
+            rows = self._execute('SELECT key, value FROM "{{table}}" WHERE key IN ({})'
+                                 .format(', '.join('?' * len(batch))),
+                                 batch)
+            found.update((key, json.loads(value)) for key, value in rows)
+
+        return found
+
+
+class ResponseArchive(object) :
+    """
+    HTTP responses stored by key in a sqlite file, with the get and set
+    methods of a scrapelib cache storage.
+
+    Bodies are compressed and stored once per distinct content, so the
+    many identical pages Legistar serves take the space of one. If
+    max_bytes is given, the least recently used responses are evicted
+    when the compressed bodies outgrow it.
+    """
+    def __init__(self, path, max_bytes=None, table='responses') :
+        self.path = path
+        self.max_bytes = max_bytes
+        self.keys_table = table + '_keys'
+        self.bodies_table = table + '_bodies'
+        self._connection, self._lock = connect(path)
+
+        with self._lock, self._connection :
+            self._connection.execute('CREATE TABLE IF NOT EXISTS "{}" '
+                                     '(key TEXT PRIMARY KEY, url TEXT, status INTEGER, '
+                                     'headers TEXT, digest TEXT, used REAL)'.format(self.keys_table))
+            self._connection.execute('CREATE INDEX IF NOT EXISTS "{0}_used" '
+                                     'ON "{0}" (used)'.format(self.keys_table))
+            self._connection.execute('CREATE TABLE IF NOT EXISTS "{}" '
+                                     '(digest TEXT PRIMARY KEY, size INTEGER, body BLOB)'.format(self.bodies_table))
+
+        self._bytes = self._size()
+
+    def _execute(self, sql, parameters=()) :
+        with self._lock, self._connection :
+            return self._connection.execute(sql.format(keys=self.keys_table,
+                                                       bodies=self.bodies_table),
+                                            parameters)
+
+    def _size(self) :
+        return self._execute('SELECT COALESCE(SUM(size), 0) FROM "{bodies}"').fetchone()[0]
+
+    def get(self, key) :
+        row = self._execute('SELECT k.url, k.status, k.headers, b.body '
+                            'FROM "{keys}" k JOIN "{bodies}" b ON k.digest = b.digest '
+                            'WHERE k.key = ?', (key,)).fetchone()
+        if row is None :
+            return None
+
+        url, status, headers, body = row
+        self._execute('UPDATE "{keys}" SET used = ? WHERE key = ?', (time.time(), key))
+
+        response = requests.Response()
+        response.status_code = status
+        response.headers = requests.structures.CaseInsensitiveDict(json.loads(headers))
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response._content = zlib.decompress(body)
+        response._content_consumed = True
+        response.url = url
+        return response
+
+    def set(self, key, response) :
+        content = response.content
+        digest = hashlib.sha256(content).hexdigest()
+
+        with self._lock, self._connection :
+            known = self._connection.execute('SELECT 1 FROM "{}" WHERE digest = ?'
+                                             .format(self.bodies_table),
+                                             (digest,)).fetchone()
+            if not known :
+                body = zlib.compress(content)
+                self._connection.execute('INSERT INTO "{}" (digest, size, body) VALUES (?, ?, ?)'
+                                         .format(self.bodies_table),
+                                         (digest, len(body), body))
+                self._bytes += len(body)
+
+            replaced = self._connection.execute('SELECT digest FROM "{}" WHERE key = ?'
+                                                .format(self.keys_table),
+                                                (key,)).fetchone()
+
+            self._connection.execute('INSERT OR REPLACE INTO "{}" '
+                                     '(key, url, status, headers, digest, used) '
+                                     'VALUES (?, ?, ?, ?, ?, ?)'.format(self.keys_table),
+                                     (key, response.url, response.status_code,
+                                      json.dumps(dict(response.headers)), digest,
+                                      time.time()))
+
+            # Drop the body this key used to have, if nothing else has it
+            if replaced and replaced[0] != digest :
+                orphan = self._connection.execute('SELECT size FROM "{}" WHERE digest = ? AND digest NOT IN '
+                                                  '(SELECT digest FROM "{}")'
+                                                  .format(self.bodies_table, self.keys_table),
+                                                  replaced).fetchone()
+                if orphan :
+                    self._connection.execute('DELETE FROM "{}" WHERE digest = ?'
+                                             .format(self.bodies_table),
+                                             replaced)
+                    self._bytes -= orphan[0]
+
+        if self.max_bytes is not None and self._bytes > self.max_bytes :
+            self.evict()
+
+    def evict(self) :
+        """Drop least recently used responses until within max_bytes"""
+        with self._lock :
+            self._bytes = self._size()
+            while self._bytes > self.max_bytes :
+                with self._connection :
+                    evicted = self._connection.execute(
+                        'DELETE FROM "{0}" WHERE key IN '
+                        '(SELECT key FROM "{0}" ORDER BY used LIMIT 100)'
+                        .format(self.keys_table)).rowcount
+                    self._connection.execute(
+                        'DELETE FROM "{}" WHERE digest NOT IN (SELECT digest FROM "{}")'
+                        .format(self.bodies_table, self.keys_table))
+                self._bytes = self._size()
+                if not evicted :
+                    break
@@ -0,0 +1,61 @@
+"""
+Benchmark for the memoized date conversion in legistar.base, over a
+column of dates shaped like a legislation history or events grid: many
+rows falling on a few hundred distinct meeting dates.
+
+    python scripts/bench_dates.py [rows] [distinct dates]
+"""
+import datetime
+import random
+import sys
+import timeit
+
+import pytz
+
+from legistar.base import localTime
+
+
+TIMEZONE = 'America/Chicago'
+WEB_FORMAT = '%m/%d/%Y'
+API_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def strptimeLocalTime(text, date_format, timezone_name) :
+    """The conversion as it was, parsing and looking up the zone every call"""
+    time = datetime.datetime.strptime(text, date_format)
+    return pytz.timezone(timezone_name).localize(time)
+
+
+def column(n_rows, n_dates, date_format) :
+    random.seed(0)
+    first = datetime.datetime(2010, 1, 1)
+    dates = [(first + datetime.timedelta(days=random.randrange(3650)))
+             .strftime(date_format)
+             for _ in range(n_dates)]
+    return [random.choice(dates) for _ in range(n_rows)]
+
+
+def best(convert, dates, date_format, repeats=5) :
+    def run() :
+        localTime.cache_clear()
+        for text in dates :
+            convert(text, date_format, TIMEZONE)
+
+    return min(timeit.repeat(run, number=1, repeat=repeats))
+
+
+if __name__ == '__main__' :
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    n_dates = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    print('rows: {}, distinct dates: {}'.format(n_rows, n_dates))
+    for date_format in (WEB_FORMAT, API_FORMAT) :
+        dates = column(n_rows, n_dates, date_format)
+
+        before = best(strptimeLocalTime, dates, date_format)
+        after = best(localTime, dates, date_format)
+
+        print('{}'.format(date_format))
+        print('  strptime + pytz.timezone: {:.2f} us/date'.format(before / n_rows * 1e6))
+        print('  localTime:                {:.2f} us/date'.format(after / n_rows * 1e6))
+        print('  speedup:                  {:.1f}x'.format(before / after))
@@ -0,0 +1,73 @@
+"""
+Micro-benchmark for LegistarScraper.parseDataTable, comparing the
+precompiled XPath registry with evaluating the same expressions as
+strings on every call.
+
+    python scripts/bench_xpath.py [rows] [repeats]
+"""
+import sys
+import timeit
+
+import lxml.html
+
+from legistar.base import LegistarScraper
+
+
+ROW = ('<tr class="{cls}">'
+       '<td><a href="/LegislationDetail.aspx?ID={i}&amp;GUID=ABC">O2017-{i}</a></td>'
+       '<td>Ordinance</td>'
+       '<td>Passed</td>'
+       '<td>01/{day:02}/2017</td>'
+       '<td><em>Amendment</em> of Municipal Code<br/>Chapter {i}</td>'
+       '</tr>')
+
+HEADERS = ('<tr>'
+           '<th class="rgHeader">Record #</th>'
+           '<th class="rgHeader">Type</th>'
+           '<th class="rgHeader">Status</th>'
+           '<th class="rgHeader">Intro Date</th>'
+           '<th class="rgHeader">Title</th>'
+           '</tr>')
+
+
+class StringXPathScraper(LegistarScraper) :
+    """Evaluates registry expressions without the compiled cache."""
+    def xpath(self, element, name, **variables) :
+        return element.xpath(self.XPATHS[name], **variables)
+
+
+def table(n_rows) :
+    rows = ''.join(ROW.format(cls='rgRow' if i % 2 else 'rgAltRow',
+                              i=i, day=i % 28 + 1)
+                   for i in range(n_rows))
+    page = lxml.html.fromstring('<html><body><table class="rgMasterTable">'
+                                '<thead>{}</thead><tbody>{}</tbody>'
+                                '</table></body></html>'.format(HEADERS, rows))
+    return page.xpath("//table[@class='rgMasterTable']")[0]
+
+
+def per_row(scraper_class, n_rows, repeats) :
+    # parseDataTable only needs BASE_URL, so skip the pupa setup
+    scraper = scraper_class.__new__(scraper_class)
+    scraper.BASE_URL = 'https://example.legistar.com/'
+    grid = table(n_rows)
+
+    def parse() :
+        for _ in scraper.parseDataTable(grid) :
+            pass
+
+    best = min(timeit.repeat(parse, number=1, repeat=repeats))
+    return best / n_rows
+
+
+if __name__ == '__main__' :
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    before = per_row(StringXPathScraper, n_rows, repeats)
+    after = per_row(LegistarScraper, n_rows, repeats)
+
+    print('rows: {}'.format(n_rows))
+    print('string xpath:   {:.2f} us/row'.format(before * 1e6))
+    print('compiled xpath: {:.2f} us/row'.format(after * 1e6))
+    print('speedup:        {:.2f}x'.format(before / after))
@@ -8,6 +8,8 @@ from os.path import join
 
 import scrapelib
 
+from legistar.storage import ResponseArchive
+
 path = '/home/thom/sunlight/python-opencivicdata/opencivicdata/division-ids/identifiers/country-us'
 
 
@@ -42,7 +44,7 @@ class Checker(scrapelib.Scraper):
             self.cache_write_only = False
 
         cache_dir = '.cache'
-        self.cache_storage = scrapelib.FileCache(cache_dir)
+        self.cache_storage = ResponseArchive(join(cache_dir, 'archive.sqlite3'))
 
     def __enter__(self):
         self.outfile = open(self.OUTFILE, 'w')
@@ -0,0 +1,111 @@
+import json
+from unittest import mock
+
+import requests
+
+from pupa.scrape import Jurisdiction
+
+from legistar.base import LegistarAPIScraper, TableRow, TableSchema
+
+
+class ExampleJurisdiction(Jurisdiction):
+    division_id = 'ocd-division/country:us/state:ex/place:example'
+    classification = 'government'
+    name = 'Example'
+    url = 'http://example.com'
+
+
+def test_table_row_copy_and_to_dict():
+    row = TableRow(TableSchema(['Name', 'Date']), ['Council', '01/09/2017'])
+    row['url'] = 'http://example.com'
+
+    copy = row.copy()
+    copy['Name'] = 'Committee'
+    copy['extra'] = 1
+
+    assert row == {'Name': 'Council', 'Date': '01/09/2017',
+                   'url': 'http://example.com'}
+    assert copy['Name'] == 'Committee' and 'extra' not in row
+    assert json.loads(json.dumps(row.to_dict())) == row
+    assert row['missing'] is None
+
+
+def test_skip_prefetch_stops_at_last_page(tmpdir):
+    scraper = LegistarAPIScraper(ExampleJurisdiction(), str(tmpdir))
+    items = [{'Id': i} for i in range(2500)]
+    skips = []
+
+    def get_json(url, params):
+        skips.append(params['$skip'])
+        return items[params['$skip']:params['$skip'] + 1000]
+
+    with mock.patch.object(scraper, '_get_json', side_effect=get_json):
+        found = list(scraper.pages('http://example.com/matters', item_key='Id',
+                                   keyset=False, prefetch=3))
+
+    assert found == items
+    assert sorted(skips)[:3] == [0, 1000, 2000]
+    assert len(skips) <= 1 + 3
+
+
+def test_skip_prefetch_short_first_page(tmpdir):
+    scraper = LegistarAPIScraper(ExampleJurisdiction(), str(tmpdir))
+
+    with mock.patch.object(scraper, '_get_json', return_value=[{'Id': 1}]) as get_json:
+        found = list(scraper.pages('http://example.com/matters', item_key='Id',
+                                   keyset=False, prefetch=3))
+
+    assert found == [{'Id': 1}]
+    assert get_json.call_count == 1
+
+
+class StubAdapter(requests.adapters.BaseAdapter):
+    """Answers with ETag "v1", or 304 when the request already has it"""
+
+    def __init__(self):
+        super(StubAdapter, self).__init__()
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request)
+
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.headers['ETag'] = '"v1"'
+        if request.headers.get('If-None-Match') == '"v1"':
+            response.status_code = 304
+            response._content = b''
+        else:
+            response.status_code = 200
+            response._content = b'[{"MatterId": 1}]'
+        return response
+
+    def close(self):
+        pass
+
+
+def test_conditional_get(tmpdir):
+    scraper = LegistarAPIScraper(ExampleJurisdiction(), str(tmpdir))
+    scraper.STATE_DIR = str(tmpdir)
+    scraper.CONDITIONAL_GET = True
+    scraper.cache_storage = None
+    scraper.requests_per_minute = 0
+
+    adapter = StubAdapter()
+    scraper.mount('http://', adapter)
+    scraper.BASE_URL = 'http://webapi.legistar.com/v1/example'
+    url = scraper.BASE_URL + '/matters/1'
+
+    first = scraper.get(url)
+    second = scraper.get(url)
+
+    assert 'If-None-Match' not in adapter.sent[0].headers
+    assert adapter.sent[1].headers['If-None-Match'] == '"v1"'
+    assert first.status_code == second.status_code == 200
+    assert second.json() == first.json() == [{'MatterId': 1}]
+
+    assert scraper.stats['conditional misses /matters/{id}'] == 1
+    assert scraper.stats['conditional revalidations /matters/{id}'] == 1
+    assert scraper.stats['conditional hits /matters/{id}'] == 1
+    assert scraper.responseStore().max_bytes == scraper.CONDITIONAL_STORE_MAX_BYTES
@@ -0,0 +1,46 @@
+from unittest import mock
+
+import pytest
+from pupa.scrape import Jurisdiction
+
+from legistar.bills import LegistarAPIBillScraper
+
+
+class ExampleJurisdiction(Jurisdiction):
+    division_id = 'ocd-division/country:us/state:ex/place:example'
+    classification = 'government'
+    name = 'Example'
+    url = 'http://example.com'
+
+
+@pytest.fixture
+def scraper(tmpdir):
+    scraper = LegistarAPIBillScraper(ExampleJurisdiction(), str(tmpdir))
+    scraper.STATE_DIR = str(tmpdir)
+    scraper.BASE_WEB_URL = 'https://example.legistar.com'
+    return scraper
+
+
+def redirect(location):
+    return mock.Mock(headers={'Location': location})
+
+
+def test_detail_route_is_kept(scraper):
+    route = '/LegislationDetail.aspx?ID=1&GUID=ABC'
+
+    with mock.patch.object(scraper, 'head', return_value=redirect(route)) as head:
+        assert scraper.legislation_detail_url(1) == scraper.BASE_WEB_URL + route
+        assert scraper.legislation_detail_url(1) == scraper.BASE_WEB_URL + route
+
+    assert head.call_count == 1
+
+
+def test_unexpected_route_is_not_kept(scraper):
+    route = '/LegislationDetail.aspx?ID=1&GUID=ABC'
+    answers = [redirect('/Error.aspx'), redirect(route)]
+
+    with mock.patch.object(scraper, 'head', side_effect=answers) as head:
+        assert scraper.legislation_detail_url(1) == scraper.BASE_WEB_URL + '/Error.aspx'
+        assert scraper.legislation_detail_url(1) == scraper.BASE_WEB_URL + route
+
+    assert head.call_count == 2
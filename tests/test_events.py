@@ -0,0 +1,80 @@
+from collections import Counter
+from unittest import mock
+
+import pytest
+from pupa.scrape import Jurisdiction
+
+from legistar.events import LegistarAPIEventScraper
+
+
+class ExampleJurisdiction(Jurisdiction):
+    division_id = 'ocd-division/country:us/state:ex/place:example'
+    classification = 'government'
+    name = 'Example'
+    url = 'http://example.com'
+
+
+BASE_URL = 'http://webapi.legistar.com/v1/example'
+
+EVENT_IDS = [101, 102, 103]
+
+
+def event_items(event_id):
+    return [{'EventItemId': event_id * 10 + i,
+             'EventItemTitle': 'Item {}'.format(i),
+             'EventItemMinutesSequence': i,
+             'EventItemAgendaSequence': i,
+             'EventItemRollCallFlag': i % 2}
+            for i in range(4)]
+
+
+@pytest.fixture
+def scraper(tmpdir):
+    scraper = LegistarAPIEventScraper(ExampleJurisdiction(), str(tmpdir))
+    scraper.BASE_URL = BASE_URL
+    return scraper
+
+
+@pytest.fixture
+def requests_made(scraper):
+    requests_made = Counter()
+
+    def get(url, **kwargs):
+        requests_made[url] += 1
+        route = url[len(BASE_URL):]
+        if route.endswith('/eventitems'):
+            body = event_items(int(route.split('/')[2]))
+        else:
+            body = [{'RollCallId': 1}]
+        return mock.Mock(json=mock.Mock(return_value=body))
+
+    with mock.patch.object(scraper, 'get', side_effect=get):
+        yield requests_made
+
+
+def test_agenda_and_rollcalls_fetch_eventitems_once(scraper, requests_made):
+    for event_id in EVENT_IDS:
+        event = {'EventId': event_id}
+        agenda = list(scraper.agenda(event))
+        rollcalls = list(scraper.rollcalls(event))
+
+        assert [item['EventItemId'] for item in agenda] == \
+            [item['EventItemId'] for item in event_items(event_id)]
+        assert len(rollcalls) == 2
+
+    for event_id in EVENT_IDS:
+        url = BASE_URL + '/events/{}/eventitems'.format(event_id)
+        assert requests_made[url] == 1
+
+    assert scraper.stats['GET /events/{id}/eventitems'] == len(EVENT_IDS)
+
+
+def test_eventitems_cache_evicts(scraper, requests_made):
+    scraper._event_items.maxsize = 2
+
+    for event_id in EVENT_IDS + EVENT_IDS[:1]:
+        list(scraper.agenda({'EventId': event_id}))
+
+    assert len(scraper._event_items) == 2
+    url = BASE_URL + '/events/{}/eventitems'.format(EVENT_IDS[0])
+    assert requests_made[url] == 2
@@ -0,0 +1,38 @@
+import io
+import json
+
+import pytest
+
+from legistar import jsonstream
+from legistar.jsonstream import loadObject
+
+
+def load(text):
+    return loadObject(io.BytesIO(text.encode('utf-8')))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 13, 64 * 1024])
+def test_string_split_across_chunks(monkeypatch, chunk_size):
+    monkeypatch.setattr(jsonstream, 'CHUNK_SIZE', chunk_size)
+    document = {'MatterTextId': 1,
+                'MatterTextRtf': '{\\rtf1 café "quoted" \U0001f600\n' * 20,
+                'MatterTextPlain': 'tab\there \\ slash',
+                'MatterTextLastModifiedUtc': None,
+                'MatterTextRowVersion': True}
+
+    assert load(json.dumps(document)) == document
+    assert load(json.dumps(document, ensure_ascii=False)) == document
+
+
+def test_malformed_object():
+    with pytest.raises(ValueError, match='Expected , or }'):
+        load('{"a": "b" "c": 1}')
+
+
+def test_nested_values_fall_back_to_json():
+    assert load('{"a": [1, 2], "b": {"c": "d"}}') == {'a': [1, 2], 'b': {'c': 'd'}}
+
+
+def test_truncated_document():
+    with pytest.raises(ValueError):
+        load('{"a": "unterminated')
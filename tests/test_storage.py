@@ -0,0 +1,31 @@
+import threading
+
+import requests
+
+from legistar.storage import ResponseArchive
+
+
+def response(content):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = 'http://example.com'
+    response._content = content
+    return response
+
+
+def test_archive_tracks_size_when_bodies_are_replaced(tmpdir):
+    archive = ResponseArchive(str(tmpdir.join('archive.sqlite3')))
+
+    def write(thread):
+        for i in range(50):
+            archive.set('key {}'.format(i % 10),
+                        response('{} {}'.format(thread, i).encode() * 20))
+
+    threads = [threading.Thread(target=write, args=(thread,)) for thread in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert archive._bytes == archive._size()
+
@@ -0,0 +1,79 @@
+from unittest import mock
+
+import lxml.html
+import pytest
+from pupa.scrape import Jurisdiction
+
+from legistar.base import LegistarScraper
+
+
+class ExampleJurisdiction(Jurisdiction):
+    division_id = 'ocd-division/country:us/state:ex/place:example'
+    classification = 'government'
+    name = 'Example'
+    url = 'http://example.com'
+
+
+URL = 'http://example.legistar.com/Legislation.aspx'
+
+GRID = '''<html><body>
+<table id="ctl00_ContentPlaceHolder1_gridMain_ctl00">
+  <thead><tr>
+    <th class="rgHeader">File #</th>
+    <th class="rgHeader">Title</th>
+    <th class="rgHeader">Date</th>
+  </tr></thead>
+  <tbody>
+{}
+  </tbody>
+</table>
+</body></html>'''
+
+ROW = '''    <tr class="{cls}">
+      <td><a href="LegislationDetail.aspx?ID={i}">{i}-2017</a></td>
+      <td>Title {i}</td>
+      <td>01/{day:02d}/2017</td>
+    </tr>'''
+
+GRID_PAGE = GRID.format('\n'.join(ROW.format(cls='rgAltRow' if i % 2 else 'rgRow',
+                                             i=i, day=i + 1)
+                                  for i in range(12)))
+
+NO_GRID_PAGE = '<html><body><p>No records to display.</p></body></html>'
+
+
+@pytest.fixture
+def scraper(tmpdir):
+    scraper = LegistarScraper(ExampleJurisdiction(), str(tmpdir))
+    scraper.BASE_URL = 'http://example.legistar.com'
+    scraper.STREAM_CHUNK_SIZE = 64
+    return scraper
+
+
+def serve(scraper, html):
+    body = html.encode('utf-8')
+    chunks = lambda chunk_size: (body[i:i + chunk_size]
+                                 for i in range(0, len(body), chunk_size))
+    response = mock.Mock(url=URL, encoding='utf-8', text=html,
+                         iter_content=mock.Mock(side_effect=chunks))
+    return mock.patch.object(scraper, 'get', return_value=response)
+
+
+def test_stream_matches_parse(scraper):
+    with serve(scraper, GRID_PAGE):
+        streamed = [(dict(row), keys) for row, keys, _
+                    in scraper.streamDataTable(URL)]
+
+    page = lxml.html.fromstring(GRID_PAGE)
+    page.make_links_absolute(URL)
+    parsed = [(dict(row), keys) for row, keys, _
+              in scraper.parseDataTable(scraper.xpath(page, 'main_grid')[0])]
+
+    assert len(streamed) == 12
+    assert streamed == parsed
+
+
+def test_stream_without_grid_raises(scraper):
+    with serve(scraper, NO_GRID_PAGE):
+        with pytest.raises(IndexError):
+            list(scraper.streamDataTable(URL))